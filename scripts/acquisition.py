@@ -0,0 +1,188 @@
+#!/usr/bin/python3
+#-*- coding: utf-8 -*-
+
+"""
+Continuous acquisition of spectra, with the camera download, RAW decoding, extraction and stitching running
+as overlapping stages in separate threads.
+
+The stages are connected by bounded queues: when a later stage is slower, the earlier ones block instead of
+piling up frames in memory, so the steady rate is given by the slowest stage, not by the sum of all of them.
+(Both rawpy and the numpy routines release the GIL for the heavy work, so threads suffice here.)
+"""
+
+import io
+import queue
+import threading
+import time
+
+import echelle_process
+import hdr
+
+
+_end_of_stream = object()
+
+class Frame():
+    """ A single frame passed through the pipeline; each stage fills in its own attribute """
+    def __init__(self, index, settings):
+        self.index      = index
+        self.settings   = dict(settings)      ## camera settings at the capture, e.g. the shutter speed
+        self.timestamp  = time.time()
+        self.raw_data   = None
+        self.image      = None
+        self.table      = None      ## TraceTable of the extraction, shared by all frames of the same shape
+        self.intensities = None     ## 2D array (order × column)
+        self.spectrum   = None
+        self.drift      = None      ## filled in by an optional tracking stage, see drift_tracking.py
+
+
+class Pipeline():
+    """
+    Input:
+        camera          - camera object as defined in camera.py (opened and closed by the pipeline)
+        params          - echelle parameters, e.g. complete_params(load_echelle_parameters(...))
+        queue_size      - max. number of frames waiting between two stages
+        bracket         - optional list of shutter speeds; each spectrum is then computed from an HDR merge of images
+                          taken with all of them (see hdr.py)
+        calibration     - optional master dark/flat frames (calibration_frames.CalibrationFrames), applied in decoding
+                          of the single (not bracketed) frames
+    The stages can be replaced or extended by modifying the list `self.stages` of (name, function(frame)) pairs.
+    """
+    def __init__(self, camera, params, decimate_factor=4, method='aperture', queue_size=2, bracket=None,
+            calibration=None):
+        self.camera          = camera
+        self.calibration     = calibration
+        self.bracket         = bracket
+        self.params          = params
+        self.decimate_factor = decimate_factor
+        self.method          = method
+        self.queue_size      = queue_size
+        self.stages = [
+                ('decode',  self.decode),
+                ('extract', self.extract),
+                ('stitch',  self.stitch),
+                ]
+        self.stage_times = {}
+
+    def capture(self, frame):
+        if self.bracket:
+            frame.raw_data = hdr.capture_bracket(self.camera, self.bracket)
+        else:
+            frame.raw_data = self.camera.capture()
+
+    def decode(self, frame):
+        if self.bracket:
+            frame.image = echelle_process.decimate(hdr.merge_raw_data(frame.raw_data), self.decimate_factor)
+            frame.image -= frame.image.min()
+        else:
+            frame.image = echelle_process.load_raw(io.BytesIO(frame.raw_data),
+                    decimate_factor=self.decimate_factor, params=self.params, calibration=self.calibration)
+        frame.raw_data = None
+
+    def extract(self, frame):
+        frame.table, frame.intensities = echelle_process.extract_orders(frame.image, self.params, method=self.method)
+
+    def stitch(self, frame):
+        ## the stitcher is cached in the trace table, so it is built only once for the whole run
+        stitcher = frame.table.stitcher()
+        frame.spectrum = stitcher.grid, stitcher(frame.intensities)
+
+    def _capture_loop(self, n_frames, outqueue):
+        index = 0
+        try:
+            while not self.stop_event.is_set() and (n_frames is None or index < n_frames):
+                frame = Frame(index, self.camera.settings)
+                t0 = time.time()
+                try:
+                    self.capture(frame)
+                except StopIteration:
+                    break
+                self.stage_times['capture'] += time.time() - t0
+                outqueue.put(frame)
+                index += 1
+        except Exception as e:
+            self._fail(e)
+        finally:
+            outqueue.put(_end_of_stream)
+
+    def _stage_loop(self, name, function, inqueue, outqueue):
+        ## after an error anywhere, the frames are only drained, so that no stage stays blocked on a full queue
+        while True:
+            frame = inqueue.get()
+            if frame is _end_of_stream:
+                break
+            if self.stop_event.is_set() and self.errors:
+                continue
+            t0 = time.time()
+            try:
+                function(frame)
+            except Exception as e:
+                self._fail(e)
+                continue
+            self.stage_times[name] += time.time() - t0
+            outqueue.put(frame)
+        outqueue.put(_end_of_stream)
+
+    def _fail(self, exception):
+        self.errors.append(exception)
+        self.stop_event.set()
+
+    def run(self, n_frames=None, on_spectrum=None):
+        """
+        Acquires `n_frames` spectra (or runs until stop() is called, or until the camera runs out of frames),
+        and calls `on_spectrum(frame)` for each of them in the calling thread.
+        Output:
+            number of processed frames
+        """
+        self.stop_event = threading.Event()
+        self.errors = []
+        self.stage_times = {name:0. for name in ['capture'] + [name for name, function in self.stages]}
+        queues = [queue.Queue(maxsize=self.queue_size) for n in range(len(self.stages)+1)]
+        threads = [threading.Thread(target=self._capture_loop, args=(n_frames, queues[0]), name='capture', daemon=True)]
+        for (name, function), inqueue, outqueue in zip(self.stages, queues[:-1], queues[1:]):
+            threads.append(threading.Thread(target=self._stage_loop, args=(name, function, inqueue, outqueue),
+                    name=name, daemon=True))
+
+        processed, finished = 0, False
+        self.t_start = time.time()
+        try:
+            with self.camera:
+                for thread in threads:
+                    thread.start()
+                try:
+                    while True:
+                        frame = queues[-1].get()
+                        if frame is _end_of_stream:
+                            finished = True
+                            break
+                        processed += 1
+                        if on_spectrum is not None and not self.errors:
+                            try:
+                                on_spectrum(frame)
+                            except Exception as e:
+                                self._fail(e)
+                finally:
+                    ## e.g. on Ctrl+C: the frames still in the stages are discarded, and the camera is closed only
+                    ## after the capture thread has left capture()
+                    if not finished:
+                        self.stop_event.set()
+                        while queues[-1].get() is not _end_of_stream:
+                            pass
+                    for thread in threads:
+                        thread.join()
+        finally:
+            self.t_total = time.time() - self.t_start
+            self.processed = processed
+        if self.errors:
+            raise self.errors[0]
+        return processed
+
+    def stop(self):
+        self.stop_event.set()
+
+    def report(self):
+        """ Summary of the last run: overall rate, and the busy time of each stage per frame """
+        if not getattr(self, 'processed', 0):
+            return "No spectra acquired"
+        return "{} spectra in {:.2f} s, i.e. {:.2f} spectra/s; per frame: {}".format(
+                self.processed, self.t_total, self.processed/self.t_total,
+                ', '.join('{} {:.3f} s'.format(name, t/self.processed) for name, t in self.stage_times.items()))
@@ -0,0 +1,196 @@
+#!/usr/bin/python3
+#-*- coding: utf-8 -*-
+
+"""
+Automatic wavelength calibration from an image of a neon lamp.
+
+The bright spots are located in the image and their centroids are matched against the tabulated neon lines,
+as predicted by the current echelle parameters in all diffraction orders. The parameters of the grating and
+prism model are then fitted by least squares to the positions of the matched lines; the matching and fitting
+are repeated with a shrinking matching radius. Before that, a common translation of all
+lines is searched for. The initial parameters thus need to be roughly right only up to a shift: after removing it,
+most predicted lines should fall within `initial_radius_px` from the actual ones - as is the case after a minor
+realignment, or after a coarse manual setup in gui_setup.py.
+
+Usage:
+    ./autocalibrate.py ../image_logs/neon.cr2 -s gui_setup/echelle_settings.dat -o gui_setup/echelle_settings.dat
+"""
+
+import argparse
+
+import numpy as np
+from scipy import ndimage, optimize, spatial
+
+import echelle_process
+import line_catalog
+
+
+## The parameters adjusted by the fit; the CMOS width and the prism angle are left fixed, since the former only
+## enters as the ratio W/F, and the latter is nearly degenerate with the refractive index
+fit_keys = ['Λ groove spacing (μm)', 'α incident angle (rad)', 'ξ horizontal camera inclination (rad)',
+        'F camera foc dist (mm)', 'κ vertical camera declination (rad)', 'prism_n0', 'prism_Sellmeyer_F0',
+        'θ image rotation (rad)']
+neon_lines_file = 'neon-nist-cropped.dat'
+
+
+def load_neon_lines(max_lines=200):
+    """ Returns the wavelengths (m) and relative intensities of the `max_lines` strongest tabulated lines """
+    return line_catalog.LineCatalog(neon_lines_file).strongest(max_lines)
+
+def detect_spots(im, max_spots=500, min_distance_px=2, threshold_sigma=5.):
+    """
+    Finds the local maxima standing out of the noise, and their 3×3 intensity-weighted centroids
+    Output:
+        (cols, rows, heights) - 1D arrays of the fractional pixel positions and the peak heights, brightest first
+    """
+    background = np.median(im)
+    noise = 1.4826 * np.median(np.abs(im - background))
+    size = 2*min_distance_px + 1
+    peaks = (im == ndimage.maximum_filter(im, size=size)) & (im > background + threshold_sigma*noise)
+    peaks[:1], peaks[-1:], peaks[:,:1], peaks[:,-1:] = False, False, False, False
+    rows, cols = np.nonzero(peaks)
+    order = np.argsort(im[rows, cols])[::-1][:max_spots]
+    rows, cols = rows[order], cols[order]
+
+    dr, dc = np.mgrid[-1:2, -1:2]
+    patches = im[rows[:,None,None] + dr, cols[:,None,None] + dc] - background
+    patches = np.clip(patches, 0, None)
+    total = np.sum(patches, axis=(1,2))
+    return (cols + np.sum(patches*dc, axis=(1,2))/total, rows + np.sum(patches*dr, axis=(1,2))/total,
+            im[rows, cols] - background)
+
+def predict_positions(wavelengths, orders, params, shape):
+    """ Image positions (fractional pixel cols and rows, as in TraceTable) of given lines in given orders """
+    xx, yy = echelle_process.sensor_to_image(echelle_process.lambda_to_x(wavelengths, orders, params),
+            echelle_process.lambda_to_y(wavelengths, params), params)
+    return xx*shape[1] - .5, (1-yy)*shape[0] - .5
+
+def coarse_offset(spot_cols, spot_rows, wavelengths, params, shape, max_shift_px=50):
+    """ 
+    Finds the translation (in pixels) of the image against the predicted lines, as the most frequent displacement
+    between the spots and the predicted lines, evaluated for all their pairs at once
+    """
+    orders = echelle_process.order_numbers(params)
+    cols, rows = predict_positions(*np.meshgrid(wavelengths, orders), params, shape)
+    visible = np.isfinite(cols) & np.isfinite(rows)
+    dcols = (spot_cols[:,None] - cols[visible][None,:]).ravel()
+    drows = (spot_rows[:,None] - rows[visible][None,:]).ravel()
+    edges = np.arange(-max_shift_px, max_shift_px+1.5) - .5
+    votes, col_edges, row_edges = np.histogram2d(dcols, drows, bins=[edges, edges])
+    votes = ndimage.uniform_filter(votes, size=3, mode='constant')
+    best_col, best_row = np.unravel_index(np.argmax(votes), votes.shape)
+    return (col_edges[best_col] + col_edges[best_col+1])/2, (row_edges[best_row] + row_edges[best_row+1])/2
+
+def shift_params(params, dcol, drow, shape):
+    """ Moves the whole image by (dcol, drow) pixels, by adjusting the camera inclination and declination """
+    fdist, cmosw = params['F camera foc dist (mm)'], params['W camera CMOS width (mm)']
+    return dict(params, **{
+            'ξ horizontal camera inclination (rad)': params['ξ horizontal camera inclination (rad)'] - dcol/shape[1]*cmosw/2/fdist,
+            'κ vertical camera declination (rad)':   params['κ vertical camera declination (rad)'] - 
+                    drow/shape[0]*cmosw*echelle_process.cmos_aspect_ratio/fdist})
+
+def match_lines(spot_cols, spot_rows, wavelengths, params, shape, radius_px):
+    """
+    Pairs each spot with the nearest predicted line (in any order), if closer than `radius_px`; each spot and each
+    line is used at most once.
+    Output:
+        (spot indices, line wavelengths, line orders) of the matched pairs
+    """
+    orders = echelle_process.order_numbers(params)
+    ll, mm = np.meshgrid(wavelengths, orders)
+    cols, rows = predict_positions(ll, mm, params, shape)
+    visible = np.isfinite(cols) & np.isfinite(rows) & (cols >= 0) & (cols < shape[1]) & (rows >= 0) & (rows < shape[0])
+    ll, mm, cols, rows = ll[visible], mm[visible], cols[visible], rows[visible]
+    if not len(ll):
+        return np.array([], dtype=int), np.array([]), np.array([])
+
+    distances, nearest = spatial.cKDTree(np.column_stack([cols, rows])).query(
+            np.column_stack([spot_cols, spot_rows]), distance_upper_bound=radius_px)
+    matched_spots = np.nonzero(np.isfinite(distances))[0]
+    ## if two spots claim the same line, the closer one wins
+    by_distance = matched_spots[np.argsort(distances[matched_spots])]
+    unique_lines, first = np.unique(nearest[by_distance], return_index=True)
+    matched_spots = by_distance[first]
+    return matched_spots, ll[nearest[matched_spots]], mm[nearest[matched_spots]]
+
+def fit_params(spot_cols, spot_rows, wavelengths, orders, params, shape, keys=fit_keys, outlier_px=1.):
+    """ 
+    Least-squares fit of the echelle parameters `keys` to the positions of the matched lines; the residuals
+    above `outlier_px` are suppressed by a robust loss function, since some of the lines are wrongly matched
+    """
+    def to_params(vector):
+        return dict(params, **dict(zip(keys, vector)))
+    def residuals(vector):
+        cols, rows = predict_positions(wavelengths, orders, to_params(vector), shape)
+        return np.nan_to_num(np.concatenate([cols - spot_cols, rows - spot_rows]), nan=1e3)
+
+    lower = [echelle_process.default_params[key][0] for key in keys]
+    upper = [echelle_process.default_params[key][2] for key in keys]
+    start = np.clip([params[key] for key in keys], lower, upper)
+    result = optimize.least_squares(residuals, start, bounds=(lower, upper), x_scale='jac', method='trf',
+            loss='soft_l1', f_scale=outlier_px)
+    return to_params(result.x)
+
+def residuals_per_order(spot_cols, spot_rows, wavelengths, orders, params, shape):
+    """ Output: list of (order, number of lines, RMS position error in pixels, RMS wavelength error in nm) """
+    cols, rows = predict_positions(wavelengths, orders, params, shape)
+    ## the position error along the order is converted to wavelength through the local dispersion
+    dispersion = np.abs(echelle_process.x_to_lambda((cols + 1)/shape[1], orders, params) -
+            echelle_process.x_to_lambda(cols/shape[1], orders, params))
+    report = []
+    for order in np.unique(orders):
+        sel = orders == order
+        err_px = np.hypot(cols[sel] - spot_cols[sel], rows[sel] - spot_rows[sel])
+        err_nm = (cols[sel] - spot_cols[sel]) * dispersion[sel] * 1e9
+        report.append((int(order), int(np.sum(sel)), np.sqrt(np.mean(err_px**2)), np.sqrt(np.mean(err_nm**2))))
+    return report
+
+def calibrate(im, params, initial_radius_px=8., final_radius_px=2., iterations=4, max_lines=200, keys=fit_keys,
+        max_shift_px=50):
+    """
+    Input:
+        im          - 2D (decimated) image of the neon lamp spectrum
+        params      - initial echelle parameters
+        max_shift_px - if nonzero, the image is first searched for a translation up to this value
+    Output:
+        (params, report) - the fitted parameters, and the per-order residuals as given by residuals_per_order()
+    """
+    params = echelle_process.complete_params(params)
+    wavelengths, intensities = load_neon_lines(max_lines)
+    spot_cols, spot_rows, heights = detect_spots(im)
+    if max_shift_px:
+        dcol, drow = coarse_offset(spot_cols[:100], spot_rows[:100], wavelengths[:max_lines//8], params, im.shape, max_shift_px)
+        params = shift_params(params, dcol, drow, im.shape)
+    ## with the large initial radius, only the strongest lines are used, to avoid mismatches among the dense weak ones
+    for radius, nlines in zip(np.geomspace(initial_radius_px, final_radius_px, iterations), 
+            np.geomspace(max_lines/8, max_lines, iterations).astype(int)):
+        matched, line_wavelengths, line_orders = match_lines(spot_cols, spot_rows, wavelengths[:nlines], params, im.shape, radius)
+        if len(matched) < len(keys):
+            raise ValueError("only {} lines matched within {:.1f} px, at least {} needed; check the initial parameters".format(
+                    len(matched), radius, len(keys)))
+        params = fit_params(spot_cols[matched], spot_rows[matched], line_wavelengths, line_orders, params, im.shape, keys,
+                outlier_px=radius/4)
+    matched, line_wavelengths, line_orders = match_lines(spot_cols, spot_rows, wavelengths, params, im.shape, final_radius_px)
+    return params, residuals_per_order(spot_cols[matched], spot_rows[matched], line_wavelengths, line_orders, params, im.shape)
+
+def print_report(report):
+    print("order  lines  RMS (px)  RMS (nm)")
+    for order, nlines, err_px, err_nm in report:
+        print("{:5d}  {:5d}  {:8.3f}  {:8.4f}".format(order, nlines, err_px, err_nm))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('raw_file_name', help='RAW image of a neon lamp')
+    parser.add_argument('-s', '--settings', default='./echelle_parameters.dat', help='initial echelle parameters')
+    parser.add_argument('-o', '--output', default=None, help='where to save the fitted parameters (default: same as --settings)')
+    parser.add_argument('-d', '--decimate', type=int, default=4, help='decimate factor')
+    parser.add_argument('-r', '--radius', type=float, default=8., help='initial matching radius (px of the decimated image)')
+    parser.add_argument('--max-shift', type=float, default=50., help='max. translation searched (px of the decimated image)')
+    args = parser.parse_args()
+
+    params = echelle_process.complete_params(echelle_process.load_echelle_parameters(args.settings))
+    npimage = echelle_process.load_raw(args.raw_file_name, decimate_factor=args.decimate)
+    params, report = calibrate(npimage, params, initial_radius_px=args.radius, max_shift_px=args.max_shift)
+    print_report(report)
+    echelle_process.save_echelle_parameters(params, args.output or args.settings)
@@ -0,0 +1,113 @@
+#!/usr/bin/python3
+#-*- coding: utf-8 -*-
+
+"""
+Headless reduction of many RAW echelle images into spectra, running in parallel on all CPU cores.
+
+Usage:
+    ./batch_reduce.py ../image_logs/                        ## all *.cr2 files in a directory
+    ./batch_reduce.py '../image_logs/*ISO100*.cr2' -s gui_setup/echelle_settings.dat -o ../spectra/
+
+For each input frame, a two-column file `<frame name>.dat` with the wavelength (nm) and intensity is written into
+the output directory, along with a `summary.dat` listing the frames, their spectral range and processing time.
+The echelle parameters are read from the settings file saved by the GUI (gui_setup.py); the master dark and
+flat frames, if given by -c, are built by calibration_frames.py.
+"""
+
+import argparse
+import concurrent.futures
+import glob
+import os
+import time
+
+import numpy as np
+
+import calibration_frames
+import echelle_process
+
+
+def find_raw_files(patterns):
+    """ Expands directories and glob patterns into a sorted list of RAW file names """
+    raw_file_names = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            pattern = os.path.join(pattern, '*.[cC][rR]2')
+        raw_file_names.extend(glob.glob(pattern))
+    return sorted(set(raw_file_names))
+
+_calibration_cache = {}
+
+def load_calibration(calibration_dir):
+    """ The master frames, loaded only once in each (worker) process """
+    ## memory-mapped, so that all workers share them through the page cache
+    if calibration_dir not in _calibration_cache:
+        _calibration_cache[calibration_dir] = calibration_frames.CalibrationFrames.load(calibration_dir)
+    return _calibration_cache[calibration_dir]
+
+def reduce_file(raw_file_name, params, outdir, decimate_factor=4, method='aperture', calibration_dir=None):
+    """ Reduces a single RAW file into a spectrum file; runs in a worker process """
+    t0 = time.time()
+    calibration = load_calibration(calibration_dir) if calibration_dir else None
+    npimage = echelle_process.load_raw(raw_file_name, decimate_factor=decimate_factor, params=params,
+            calibration=calibration)
+    wavelength, intensity = echelle_process.img2spectrum(npimage, params, method=method)
+    out_file_name = os.path.join(outdir, os.path.splitext(os.path.basename(raw_file_name))[0] + '.dat')
+    np.savetxt(out_file_name, np.vstack([wavelength*1e9, intensity]).T, fmt="%.5f %.6g",
+            header='wavelength(nm) intensity')
+    return raw_file_name, out_file_name, np.nanmin(wavelength)*1e9, np.nanmax(wavelength)*1e9, time.time()-t0
+
+def reduce_files(raw_file_names, params, outdir, processes=None, decimate_factor=4, method='aperture',
+        calibration_dir=None):
+    """
+    Reduces all files in a process pool, printing the progress and writing the summary file
+    Output:
+        list of (raw_file_name, out_file_name, min wavelength, max wavelength, seconds) for successfully reduced files
+    """
+    os.makedirs(outdir, exist_ok=True)
+    results = []
+    t0 = time.time()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as executor:
+        futures = {executor.submit(reduce_file, raw_file_name, params, outdir, decimate_factor, method,
+                calibration_dir): raw_file_name
+                for raw_file_name in raw_file_names}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as e:
+                print("Warning: could not reduce `{}`: {}".format(futures[future], e))
+                continue
+            results.append(result)
+            print("{:4d}/{:d}  {}  {:.2f} s".format(len(results), len(raw_file_names), result[1], result[4]))
+    total_time = time.time() - t0
+
+    results.sort()
+    with open(os.path.join(outdir, 'summary.dat'), 'w') as summary:
+        summary.write('#raw_file  spectrum_file  min_wavelength(nm)  max_wavelength(nm)  processing_time(s)\n')
+        for result in results:
+            summary.write('{}  {}  {:.3f}  {:.3f}  {:.3f}\n'.format(*result))
+    if results:
+        print("Reduced {} of {} frames in {:.2f} s: {:.2f} frames/s, {:.2f} s per frame in each worker".format(
+                len(results), len(raw_file_names), total_time, len(results)/total_time,
+                np.mean([result[4] for result in results])))
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('inputs', nargs='+', help='directories or glob patterns of RAW (*.cr2) files')
+    parser.add_argument('-s', '--settings', default='./echelle_parameters.dat', help='echelle parameters file')
+    parser.add_argument('-o', '--outdir', default='./spectra', help='directory for the resulting spectra')
+    parser.add_argument('-j', '--processes', type=int, default=None, help='number of worker processes (default: all cores)')
+    parser.add_argument('-d', '--decimate', type=int, default=4, help='decimate factor')
+    parser.add_argument('-m', '--method', default='aperture', choices=['nearest', 'aperture', 'optimal'],
+            help='extraction across the orders')
+    parser.add_argument('-c', '--calibration', default=None, metavar='DIR',
+            help='directory with the master dark/flat frames (see calibration_frames.py)')
+    args = parser.parse_args()
+
+    params = echelle_process.complete_params(echelle_process.load_echelle_parameters(args.settings))
+    raw_file_names = find_raw_files(args.inputs)
+    if not raw_file_names:
+        print("Warning: no RAW files found in {}".format(' '.join(args.inputs)))
+    reduce_files(raw_file_names, params, args.outdir, processes=args.processes,
+            decimate_factor=args.decimate, method=args.method, calibration_dir=args.calibration)
@@ -0,0 +1,233 @@
+#!/usr/bin/python3
+#-*- coding: utf-8 -*-
+
+"""
+Speed and accuracy benchmark of the spectrum reduction on synthetic echelle frames.
+
+The frames are rendered at full sensor resolution from the same forward model that the reduction uses
+(x_to_lambda, lambda_to_y): a smooth continuum spread along all orders, and the tabulated neon lines as point
+spread functions. Poisson and read noise are added and the result is quantized like a 12-bit RAW image. Each
+frame then passes the stages of load_raw and img2spectrum, which are timed separately:
+    load        - reading the full-resolution frame from disk (a .npy file standing in for the RAW decoding)
+    preprocess  - cropping to the order band, block averaging and background subtraction (preprocess_raw, i.e.
+                  the array-level part of load_raw, with the same defaults)
+    setup       - building the trace table and the stitching matrix (once for each shape and parameters)
+    extract     - extraction of all orders
+    stitch      - merging the orders onto the common wavelength grid
+The accuracy is given by the wavelength error of the line centroids in the composite spectrum (the systematic
+shift and the RMS scatter around it), and by the relative intensity error of the extracted continuum.
+
+Usage:
+    ./benchmark.py                                          ## default sensor, decimate factors 2, 4 and 8
+    ./benchmark.py --shape 2304x3456 1152x1728 --orders 4-16 6-12 --noise 3 30 -d 4 -o benchmark.dat
+"""
+
+import argparse
+import itertools
+import os
+import tempfile
+import time
+
+import numpy as np
+
+import echelle_process
+import line_catalog
+
+
+def render_spots(shape, cols, rows, amplitudes, sigma_px):
+    """ Sum of 2D Gaussians of unit integral × amplitude, centred at fractional pixel positions (pixel centres are integers) """
+    radius = int(np.ceil(4*sigma_px))
+    offsets = np.arange(-radius, radius+1)
+    pixel_rows = np.rint(rows).astype(int)[:,None,None] + offsets[None,:,None]
+    pixel_cols = np.rint(cols).astype(int)[:,None,None] + offsets[None,None,:]
+    weights = np.exp(-((pixel_rows - rows[:,None,None])**2 + (pixel_cols - cols[:,None,None])**2) / (2*sigma_px**2))
+    weights *= (amplitudes / (2*np.pi*sigma_px**2))[:,None,None]
+    inside = (pixel_rows >= 0) & (pixel_rows < shape[0]) & (pixel_cols >= 0) & (pixel_cols < shape[1])
+    return np.bincount((pixel_rows*shape[1] + pixel_cols)[inside], weights=weights[inside],
+            minlength=shape[0]*shape[1]).reshape(shape)
+
+def render_continuum(shape, params, continuum, sigma_px):
+    """ The continuum(λ) spread along all orders, as counts per image column, with a Gaussian profile across """
+    table = echelle_process.TraceTable(params, shape)
+    visible = table.valid
+    cols, rows = table.cols[visible], table.rowsf[visible] - .5
+    radius = int(np.ceil(4*sigma_px))
+    offsets = np.arange(-radius, radius+1)
+    pixel_rows = np.rint(rows).astype(int)[:,None] + offsets[None,:]
+    pixel_cols = np.broadcast_to(np.rint(cols).astype(int)[:,None], pixel_rows.shape)
+    weights = np.exp(-(pixel_rows - rows[:,None])**2 / (2*sigma_px**2)) / (np.sqrt(2*np.pi)*sigma_px)
+    weights *= continuum(table.lambdas[visible])[:,None]
+    inside = (pixel_rows >= 0) & (pixel_rows < shape[0]) & (pixel_cols >= 0) & (pixel_cols < shape[1])
+    return np.bincount((pixel_rows*shape[1] + pixel_cols)[inside], weights=weights[inside],
+            minlength=shape[0]*shape[1]).reshape(shape)
+
+def line_positions(wavelengths, params, shape):
+    """ Full-resolution pixel positions of the lines in all orders, as (cols, rows, wavelengths, indices into the input) """
+    orders = echelle_process.order_numbers(params)
+    ll, mm = np.meshgrid(wavelengths, orders)
+    with np.errstate(invalid='ignore'):
+        xx = echelle_process.lambda_to_x(ll, mm, params)
+    imx, imy = echelle_process.sensor_to_image(xx, echelle_process.lambda_to_y(ll, params), params)
+    visible = np.isfinite(imx) & (imy > 0) & (imy < 1) & (imx >= 0) & (imx < 1)
+    index = np.broadcast_to(np.arange(len(wavelengths)), ll.shape)
+    return imx[visible]*shape[1] - .5, (1 - imy[visible])*shape[0] - .5, ll[visible], index[visible]
+
+def render_frame(shape, params, wavelengths=(), amplitudes=(), continuum=None, psf_sigma_px=1.5,
+        read_noise=3., black_level=256, white_level=4095, rng=None):
+    """
+    Input:
+        shape           - (rows, cols) of the full-resolution sensor
+        wavelengths, amplitudes - spectral lines (m) and their total counts
+        continuum       - function of λ giving the counts per image column along the orders, or None
+    Output:
+        2D uint16 array, like the visible RAW pixels
+    """
+    rng = rng or np.random.default_rng()
+    signal = np.zeros(shape)
+    if len(wavelengths):
+        cols, rows, ll, index = line_positions(np.asarray(wavelengths), params, shape)
+        signal += render_spots(shape, cols, rows, np.asarray(amplitudes)[index], psf_sigma_px)
+    if continuum is not None:
+        signal += render_continuum(shape, params, continuum, psf_sigma_px)
+    pixels = rng.poisson(signal) + rng.normal(black_level, read_noise, shape)
+    return np.clip(np.rint(pixels), 0, white_level).astype(np.uint16)
+
+def smooth_continuum(lmin=380e-9, lmax=720e-9, level=200.):
+    """ A bell-shaped continuum with some slow ripple, to make the intensity errors visible """
+    def continuum(ll):
+        u = (ll - lmin) / (lmax - lmin)
+        return np.where((u > 0) & (u < 1), level * np.abs(np.sin(np.pi*u))**.5 * (1 + .2*np.cos(7*u)), 0)
+    return continuum
+
+
+def line_centroid_errors(grid, spectrum, wavelengths, resolution_element):
+    """
+    Intensity-weighted centroids of the isolated lines in the composite spectrum, all evaluated at once in windows
+    of equal length around the true wavelengths.
+    Output:
+        1D array of (centroid - true wavelength) in m
+    """
+    neighbour = np.minimum(np.diff(wavelengths, prepend=-np.inf), np.diff(wavelengths, append=np.inf))
+    inside = (wavelengths > grid[0] + 3*resolution_element) & (wavelengths < grid[-1] - 3*resolution_element)
+    isolated = wavelengths[inside & (neighbour > 6*resolution_element)]
+    if not len(isolated):
+        return np.array([])
+    step = np.median(np.diff(grid))
+    halfwindow = max(2, int(np.ceil(2*resolution_element/step)))
+    windows = np.searchsorted(grid, isolated)[:,None] + np.arange(-halfwindow, halfwindow+1)[None,:]
+    windows = np.clip(windows, 0, len(grid)-1)
+    values = spectrum[windows]
+    values = np.clip(values - np.nanmin(values, axis=1, keepdims=True), 0, None)
+    total = np.nansum(values, axis=1)
+    usable = (total > 0) & np.all(np.isfinite(values), axis=1)
+    centroids = np.nansum(values*grid[windows], axis=1)[usable] / total[usable]
+    return centroids - isolated[usable]
+
+def time_call(repeat, function, *args, **kwargs):
+    """ Returns (median of the wall times, result of the last call) """
+    times = []
+    for n in range(repeat):
+        t0 = time.perf_counter()
+        result = function(*args, **kwargs)
+        times.append(time.perf_counter() - t0)
+    return np.median(times), result
+
+def benchmark(shape, params, decimate_factor=4, read_noise=3., method='aperture', repeat=3, n_lines=300,
+        peak_counts=3000., continuum_level=200., psf_sigma_px=1.5, black_level=256, seed=0):
+    """
+    Renders a neon frame and a continuum frame, reduces them and measures the time of each stage and the errors.
+    Output:
+        dict of the results (times in s, errors in nm and relative)
+    """
+    rng = np.random.default_rng(seed)
+    wavelengths, intensities = line_catalog.LineCatalog('neon-nist-cropped.dat').strongest(n_lines)
+    sort = np.argsort(wavelengths)
+    wavelengths = wavelengths[sort]
+    amplitudes = np.nan_to_num(intensities[sort], nan=0)
+    amplitudes = amplitudes / np.max(amplitudes) * peak_counts * 2*np.pi*psf_sigma_px**2
+    continuum = smooth_continuum(level=continuum_level)
+    neon = render_frame(shape, params, wavelengths, amplitudes, psf_sigma_px=psf_sigma_px, read_noise=read_noise,
+            black_level=black_level, rng=rng)
+    lamp = render_frame(shape, params, continuum=continuum, psf_sigma_px=psf_sigma_px, read_noise=read_noise,
+            black_level=black_level, rng=rng)
+
+    f = echelle_process.block_size(decimate_factor)
+    small_shape = (shape[0]//f, shape[1]//f)
+    def reduce_frame(pixels):
+        return echelle_process.preprocess_raw(pixels, decimate_factor=decimate_factor, params=params)
+
+    result = {'shape': '{}x{}'.format(*shape), 'orders': '{:.0f}-{:.0f}'.format(params['first_order_number'],
+            params['last_order_number']), 'decimate': f, 'read_noise': read_noise}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        file_name = os.path.join(tmpdir, 'frame.npy')
+        np.save(file_name, neon)
+        result['load'], pixels = time_call(repeat, np.load, file_name)
+    result['preprocess'], image = time_call(repeat, reduce_frame, pixels)
+    echelle_process._trace_table_cache.clear()
+    def setup():
+        table = echelle_process.TraceTable(params, small_shape)
+        table.stitcher()
+        return table
+    result['setup'], table = time_call(1, setup)
+    echelle_process.trace_table(params, small_shape).stitcher()
+    result['extract'], (table, partials) = time_call(repeat, echelle_process.extract_orders, image, params, method)
+    stitcher = table.stitcher()
+    result['stitch'], spectrum = time_call(repeat, stitcher, partials)
+    result['total'] = result['load'] + result['preprocess'] + result['extract'] + result['stitch']
+
+    ## wavelength error of the isolated lines; the resolution element is one decimated pixel, or the PSF if wider
+    dispersion = np.nanmedian(np.abs(np.diff(table.lambdas, axis=1)))
+    resolution_element = dispersion * max(1, 2.4*psf_sigma_px/f)
+    errors = line_centroid_errors(stitcher.grid, spectrum, wavelengths, resolution_element)
+    result['lines'] = len(errors)
+    result['shift_nm'] = np.mean(errors)*1e9 if len(errors) else np.nan
+    result['rms_nm'] = np.std(errors)*1e9 if len(errors) else np.nan
+
+    ## intensity error: decimation averages f×f pixels, so a column of the decimated image collects continuum/f;
+    ## without a master dark, the band minimum subtracted by preprocess_raw lies some read noise below the black
+    ## level, and the remaining pedestal shows as a flux ratio above 1
+    lamp_spectrum = stitcher(echelle_process.extract_orders(reduce_frame(lamp), params, method)[1])
+    expected = continuum(stitcher.grid) / f
+    usable = np.isfinite(lamp_spectrum) & (expected > .2*np.max(expected))
+    ratio = lamp_spectrum[usable] / expected[usable]
+    result['flux_ratio'] = np.median(ratio) if usable.any() else np.nan
+    result['intensity_rms'] = np.std(ratio / np.median(ratio)) if usable.any() else np.nan
+    return result
+
+columns = [('shape', '{}'), ('orders', '{}'), ('decimate', '{:d}'), ('read_noise', '{:.1f}'), ('load', '{:.4f}'),
+        ('preprocess', '{:.4f}'), ('setup', '{:.4f}'), ('extract', '{:.4f}'), ('stitch', '{:.4f}'), ('total', '{:.4f}'),
+        ('lines', '{:d}'), ('shift_nm', '{:.4f}'), ('rms_nm', '{:.4f}'), ('flux_ratio', '{:.3f}'), ('intensity_rms', '{:.4f}')]
+
+def format_row(result):
+    return '  '.join('{:>{}s}'.format(fmt.format(result[key]), max(len(key), 9)) for key, fmt in columns)
+
+def format_header():
+    return '  '.join('{:>{}s}'.format(key, max(len(key), 9)) for key, fmt in columns)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('-s', '--settings', default='./echelle_parameters.dat', help='echelle parameters file')
+    parser.add_argument('--shape', nargs='+', default=['2304x3456'], help='sensor sizes as ROWSxCOLS')
+    parser.add_argument('--orders', nargs='+', default=[None], help='order ranges as FIRST-LAST (default: from settings)')
+    parser.add_argument('--noise', nargs='+', type=float, default=[3.], help='read noise (counts)')
+    parser.add_argument('-d', '--decimate', nargs='+', type=int, default=[2, 4, 8], help='decimate factors')
+    parser.add_argument('-m', '--method', default='aperture', choices=['nearest', 'aperture', 'optimal'])
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='repetitions of each timed stage')
+    parser.add_argument('-o', '--output', default=None, help='also write the results into this file')
+    args = parser.parse_args()
+
+    params = echelle_process.complete_params(echelle_process.load_echelle_parameters(args.settings))
+    print(format_header())
+    results = []
+    for shape, orders, read_noise, decimate_factor in itertools.product(args.shape, args.orders, args.noise, args.decimate):
+        config = dict(params)
+        if orders:
+            config['first_order_number'], config['last_order_number'] = map(float, orders.split('-'))
+        results.append(benchmark(tuple(int(n) for n in shape.split('x')), config, decimate_factor=decimate_factor,
+                read_noise=read_noise, method=args.method, repeat=args.repeat))
+        print(format_row(results[-1]))
+    if args.output:
+        with open(args.output, 'w') as output:
+            output.write('#' + format_header()[1:] + '\n')
+            for result in results:
+                output.write(format_row(result) + '\n')
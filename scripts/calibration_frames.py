@@ -0,0 +1,167 @@
+#!/usr/bin/python3
+#-*- coding: utf-8 -*-
+
+"""
+Master dark and flat frames, and their application to the incoming RAW images.
+
+The masters are built by median or sigma-clipped stacking of many full-resolution RAW frames. Each frame is decoded
+once into a memory-mapped scratch file; the stack is then reduced in blocks of rows, so that the memory used stays
+bounded by `memory_limit_mb` regardless of the number of frames. The masters are stored as .npy files and
+memory-mapped when used.
+
+Usage:
+    ./calibration_frames.py dark '../image_logs/dark_*.cr2' -o ../calibration/
+    ./calibration_frames.py flat '../image_logs/flat_*.cr2' -o ../calibration/    ## uses the master dark, if present
+and then e.g.
+    ./batch_reduce.py ../image_logs/ -c ../calibration/
+"""
+
+import argparse
+import glob
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+import echelle_process
+import instrumentation
+
+
+master_dark_name = 'master_dark.npy'
+master_flat_name = 'master_flat.npy'
+
+
+def sigma_clipped_mean(stack, sigma=3., iterations=3, axis=0):
+    """ Mean along `axis`, iteratively ignoring the values further than `sigma` robust deviations from the median """
+    stack = np.asarray(stack, dtype=np.float32)
+    keep = np.ones(stack.shape, dtype=bool)
+    for n in range(iterations):
+        masked = np.where(keep, stack, np.nan)
+        center = np.nanmedian(masked, axis=axis, keepdims=True)
+        spread = 1.4826 * np.nanmedian(np.abs(masked - center), axis=axis, keepdims=True)
+        keep = np.abs(stack - center) <= sigma*spread + 1e-6
+    return np.sum(np.where(keep, stack, 0), axis=axis) / np.maximum(np.sum(keep, axis=axis), 1)
+
+def stack_frames(raw_file_names, output_name, method='median', memory_limit_mb=256, scratch_dir=None, dark=None,
+        subtract_black=False):
+    """
+    Input:
+        raw_file_names  - list of RAW files (or file-like objects)
+        output_name     - the resulting master frame is saved as a float32 .npy file
+        method          - 'median' or 'sigmaclip'
+        dark            - optional master dark (2D array), subtracted from each row block before stacking
+        subtract_black  - if True, the black level reported by the camera is subtracted from each frame instead
+    Output:
+        the master frame, memory-mapped from `output_name`
+    """
+    scratch_dir = tempfile.mkdtemp(dir=scratch_dir)
+    try:
+        ## decode each frame only once, into a memory-mapped (frame × row × column) scratch array
+        cube = None
+        black_levels = np.zeros(len(raw_file_names), dtype=np.float32)
+        for n, raw_file_name in enumerate(raw_file_names):
+            pixels, black_levels[n], white_level = echelle_process.read_raw(raw_file_name)
+            if cube is None:
+                cube = np.lib.format.open_memmap(os.path.join(scratch_dir, 'stack.npy'), mode='w+',
+                        dtype=pixels.dtype, shape=(len(raw_file_names),) + pixels.shape)
+            elif pixels.shape != cube.shape[1:]:
+                raise ValueError("`{}` has shape {}, while the first frame has {}".format(raw_file_name, pixels.shape, cube.shape[1:]))
+            cube[n] = pixels
+            del pixels
+        if cube is None:
+            raise ValueError("no frames to stack")
+        cube.flush()
+
+        ## reduce the stack in blocks of rows; ~4 float32 temporaries of the block are needed by the sigma clipping
+        nframes, height, width = cube.shape
+        block_rows = max(1, int(memory_limit_mb*2**20 / (nframes * width * 4 * 4)))
+        master = np.lib.format.open_memmap(output_name, mode='w+', dtype=np.float32, shape=(height, width))
+        for first_row in range(0, height, block_rows):
+            rows = slice(first_row, min(first_row + block_rows, height))
+            block = np.asarray(cube[:, rows], dtype=np.float32)
+            if dark is not None:
+                block -= dark[rows]
+            elif subtract_black:
+                block -= black_levels[:,None,None]
+            if method == 'median':
+                master[rows] = np.median(block, axis=0)
+            elif method == 'sigmaclip':
+                master[rows] = sigma_clipped_mean(block)
+            else:
+                raise ValueError("unknown stacking method `{}`".format(method))
+        master.flush()
+        del cube, master
+    finally:
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+    return np.load(output_name, mmap_mode='r')
+
+def build_master_dark(raw_file_names, outdir, **kwargs):
+    os.makedirs(outdir, exist_ok=True)
+    return stack_frames(raw_file_names, os.path.join(outdir, master_dark_name), **kwargs)
+
+def build_master_flat(raw_file_names, outdir, **kwargs):
+    """
+    The flat is stacked with the master dark subtracted (if present in `outdir`; otherwise the black level reported
+    by the camera), and normalized to median 1
+    """
+    os.makedirs(outdir, exist_ok=True)
+    dark_name = os.path.join(outdir, master_dark_name)
+    dark = np.load(dark_name, mmap_mode='r') if os.path.exists(dark_name) else None
+    flat_name = os.path.join(outdir, master_flat_name)
+    flat = stack_frames(raw_file_names, flat_name, dark=dark, subtract_black=dark is None, **kwargs)
+    scale = np.median(flat[::4, ::4])
+    flat = np.load(flat_name, mmap_mode='r+')
+    flat /= scale
+    flat.flush()
+    return np.load(flat_name, mmap_mode='r')
+
+
+class CalibrationFrames():
+    """
+    The master dark and/or flat frames, applied to the RAW pixels as
+        (pixels - dark) / flat
+    Both operations run in place on one float32 buffer, taking only the `rows` needed from the masters, so that these
+    stay memory-mapped (and shared between processes through the page cache) instead of being copied into memory.
+    Input:
+        dark, flat      - 2D arrays of the RAW image shape, or None
+    """
+    def __init__(self, dark=None, flat=None):
+        self.dark = dark
+        self.flat = flat
+
+    @classmethod
+    def load(cls, calibration_dir):
+        """ Loads (memory-maps) whichever of the master frames exist in the directory """
+        def load_master(name):
+            file_name = os.path.join(calibration_dir, name)
+            return np.load(file_name, mmap_mode='r') if os.path.exists(file_name) else None
+        return cls(dark=load_master(master_dark_name), flat=load_master(master_flat_name))
+
+    @instrumentation.timed('calibration')
+    def apply(self, pixels, rows=slice(None), black_level=0.):
+        """
+        Returns the corrected float32 copy of the `pixels`, which correspond to the `rows` of the full image; without
+        the master dark, the constant `black_level` is subtracted before the flat
+        """
+        corrected = np.subtract(pixels, self.dark[rows] if self.dark is not None else black_level, dtype=np.float32)
+        if self.flat is not None:
+            flat = self.flat[rows]
+            sensitive = flat > 0        ## dead pixels of the flat are zeroed
+            np.divide(corrected, flat, out=corrected, where=sensitive)
+            corrected[~sensitive] = 0
+        return corrected
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('kind', choices=['dark', 'flat'])
+    parser.add_argument('inputs', nargs='+', help='glob patterns of RAW (*.cr2) files')
+    parser.add_argument('-o', '--outdir', default='./calibration', help='directory for the master frames')
+    parser.add_argument('-m', '--method', default='median', choices=['median', 'sigmaclip'])
+    parser.add_argument('--memory', type=float, default=256, help='memory limit for the stacking (MB)')
+    args = parser.parse_args()
+
+    raw_file_names = sorted(set(sum([glob.glob(pattern) for pattern in args.inputs], [])))
+    print("Stacking {} frames".format(len(raw_file_names)))
+    build = build_master_dark if args.kind == 'dark' else build_master_flat
+    build(raw_file_names, args.outdir, method=args.method, memory_limit_mb=args.memory)
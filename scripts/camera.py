@@ -0,0 +1,153 @@
+#!/usr/bin/python3
+#-*- coding: utf-8 -*-
+
+"""
+Minimal interface to the camera, so that the acquisition does not depend on the actual hardware.
+
+Any camera object provides:
+    open(), close()         - start and end the session (also usable as a context manager)
+    set_config(**settings)  - e.g. set_config(shutterspeed='1/10', iso='100'), names as in `gphoto2 --list-all-config`
+    capture()               - returns the bytes of a single RAW image, ready for rawpy.imread(io.BytesIO(...))
+    capture_preview()       - returns the bytes of a small image for the live view, typically JPEG (see
+                              echelle_process.load_preview); the session stays open, so that several frames
+                              per second can be pulled
+
+GphotoCamera talks to a real camera through libgphoto2, ReplayCamera returns previously saved RAW files instead,
+so that the processing can be tested and benchmarked with no camera attached.
+"""
+
+import glob
+import itertools
+import time
+
+import instrumentation
+
+
+class GphotoCamera():
+    default_config = {
+            'imageformat':      'RAW 2',
+            'capturesizeclass': 'Full Image',
+            'shutterspeed':     '1/500',    # typically '1' or '0.5' or '1/10' etc. according to menu, use: gphoto2 --list-all-config
+            'iso':              '100',      # use '100', '200', '400', '800' or '1600' only for 350D
+            }
+    ## settings switched on for the live view and restored for capture(); those missing in the camera are skipped
+    preview_config = {
+            'imageformat':      'Small Normal JPEG',
+            'viewfinder':       1,          # live view stream, on the cameras that have it
+            }
+
+    def __init__(self, **settings):
+        self.settings = dict(self.default_config, **settings)
+        self.camera = None
+        self.saved_config = None            ## the settings replaced by preview_config, while in the live view
+
+    def open(self):
+        import gphoto2 as gp
+        self.gp = gp
+        self.camera = gp.Camera()
+        self.camera.init()
+        self.saved_config = None
+        self._push_config(self.settings)
+        return self
+
+    def set_config(self, **settings):
+        """ Pushes only the settings that differ from the current ones, since each change costs a USB round-trip """
+        changed = {key:val for key,val in settings.items() if self.settings.get(key) != val}
+        self.settings.update(settings)
+        if self.camera is not None and changed:
+            self._push_config(changed)
+
+    def _push_config(self, settings, optional=False):
+        """ Output: the previous values of the changed settings """
+        cfg = self.camera.get_config()
+        previous = {}
+        for key, val in settings.items():
+            try:
+                child = cfg.get_child_by_name(key)
+            except self.gp.GPhoto2Error:
+                if optional:
+                    continue
+                raise
+            previous[key] = child.get_value()
+            child.set_value(val)
+        self.camera.set_config(cfg)
+        return previous
+
+    def capture_preview(self):
+        if self.saved_config is None:
+            self.saved_config = self._push_config(self.preview_config, optional=True)
+        return self._capture()
+
+    def capture(self):
+        if self.saved_config is not None:
+            self._push_config(self.saved_config)
+            self.saved_config = None
+        return self._capture()
+
+    def _capture(self):
+        with instrumentation.stage('capture_preview'):
+            camera_file = self.gp.check_result(self.gp.gp_camera_capture_preview(self.camera))
+        with instrumentation.stage('usb_transfer'):
+            file_data = self.gp.check_result(self.gp.gp_file_get_data_and_size(camera_file))
+            return bytes(memoryview(file_data))
+
+    def close(self):
+        if self.camera is not None:
+            self.camera.exit()
+            self.camera = None
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class ReplayCamera():
+    """
+    Stand-in for the camera that returns the data of previously saved RAW files, in a loop.
+    Input:
+        file_names      - list of file names, or a glob pattern
+        frame_interval  - if given, capture() blocks to emulate the camera's exposure and download time (s)
+        loop            - if False, capture() raises StopIteration after the last file
+    """
+    def __init__(self, file_names, frame_interval=None, loop=True, **settings):
+        self.file_names = sorted(glob.glob(file_names)) if isinstance(file_names, str) else list(file_names)
+        if not self.file_names:
+            raise IOError("no files to replay in `{}`".format(file_names))
+        self.frame_interval = frame_interval
+        self.loop = loop
+        self.settings = dict(GphotoCamera.default_config, **settings)
+        self.file_data = {}     ## kept in memory so that the disk does not affect the benchmarks
+
+    def open(self):
+        self.file_iter = itertools.cycle(self.file_names) if self.loop else iter(self.file_names)
+        self.last_capture = time.time()
+        return self
+
+    def set_config(self, **settings):
+        self.settings.update(settings)
+
+    @instrumentation.timed('replay_capture')
+    def capture(self):
+        file_name = next(self.file_iter)
+        if file_name not in self.file_data:
+            with open(file_name, 'rb') as raw_file:
+                self.file_data[file_name] = raw_file.read()
+        if self.frame_interval:
+            time.sleep(max(0, self.last_capture + self.frame_interval - time.time()))
+            self.last_capture = time.time()
+        return self.file_data[file_name]
+
+    def capture_preview(self):
+        """ The recorded files are returned as they are; saved JPEG previews give the live view its real speed """
+        return self.capture()
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,196 @@
+#!/usr/bin/python3
+#-*- coding: utf-8 -*-
+
+"""
+Monitoring of the thermal drift of the spectrometer, from the positions and widths of the neon lines in each frame.
+
+The positions of the tabulated lines in all orders are predicted once from the echelle parameters; in each frame,
+a fixed window of pixels is cut around each of them, all into one (line × row × column) array. The centroids and
+widths then follow from a Gaussian through the brightest pixel of each window and its neighbours, in closed form
+for all lines at once. The lines
+must stay within the windows, i.e. the drift is tracked up to about `halfwindow_px` pixels; beyond that, the
+parameters need to be re-calibrated (see autocalibrate.py).
+
+Usage:
+    ./drift_tracking.py '../image_logs/neon_*.cr2' -s gui_setup/echelle_settings.dat
+    ./getspec_oop.py --continuous 0 --track drift.dat -s gui_setup/echelle_settings.dat
+"""
+
+import argparse
+import glob
+import os
+import time
+import warnings
+
+import numpy as np
+
+import autocalibrate
+import echelle_process
+
+
+class LineTracker():
+    """
+    Input:
+        params          - echelle parameters
+        shape           - shape of the (decimated) images
+        max_lines       - the strongest tabulated lines to be tracked, each in all orders where it is visible
+        halfwindow_px   - the windows span ±halfwindow_px pixels around the predicted positions
+    Attributes:
+        wavelengths, orders - 1D arrays describing the tracked lines (one entry for each line in each order)
+        cols, rows          - their predicted positions in the image
+        dispersion          - wavelength per image column at each line (m/px, signed)
+    """
+    def __init__(self, params, shape, max_lines=200, halfwindow_px=4):
+        params = echelle_process.complete_params(params)
+        wavelengths = autocalibrate.load_neon_lines(max_lines)[0]
+        ll, mm = np.meshgrid(wavelengths, echelle_process.order_numbers(params))
+        cols, rows = autocalibrate.predict_positions(ll, mm, params, shape)
+        h = halfwindow_px
+        inside = np.isfinite(cols) & np.isfinite(rows) & (cols >= h) & (cols < shape[1]-h-1) & (rows >= h) & (rows < shape[0]-h-1)
+        self.wavelengths, self.orders, self.cols, self.rows = ll[inside], mm[inside], cols[inside], rows[inside]
+        self.dispersion = (echelle_process.x_to_lambda((self.cols + 1)/shape[1], self.orders, params) -
+                echelle_process.x_to_lambda(self.cols/shape[1], self.orders, params))
+        self.shape = shape
+
+        ## flat indices of all windows, and the pixel offsets within a window
+        offsets = np.arange(-h, h+1)
+        self.origin_cols = np.rint(self.cols).astype(int)
+        self.origin_rows = np.rint(self.rows).astype(int)
+        self.window_indices = ((self.origin_rows[:,None,None] + offsets[None,:,None]) * shape[1] +
+                self.origin_cols[:,None,None] + offsets[None,None,:])
+        self.dr, self.dc = np.meshgrid(offsets, offsets, indexing='ij')
+        self.border = (np.abs(self.dr) == h) | (np.abs(self.dc) == h)
+
+    def __len__(self):
+        return len(self.wavelengths)
+
+    def measure(self, im, threshold_sigma=5.):
+        """
+        The position and width of each line are given by a Gaussian through the brightest pixel of its window and its
+        two neighbours, separately along the columns and the rows; i.e. by a parabola through their logarithms,
+        which has a closed-form vertex and curvature. Unlike the intensity moments, this is not biased towards the
+        window centre by the noise or by the truncation of the line at the window edge.
+        Input:
+            im      - 2D image, or a 3D array of images (frame × row × column)
+        Output:
+            dict of arrays (line, or frame × line): 'cols', 'rows' (centroids), 'sigma_cols', 'sigma_rows' (Gaussian
+            widths in px), 'peak' (background-subtracted height), 'valid' (the line stands above the noise)
+        """
+        im = np.asarray(im)
+        windows = im.reshape(im.shape[:-2] + (-1,))[..., self.window_indices].astype(np.float32)
+        border = windows[..., self.border]
+        background = np.median(border, axis=-1)
+        noise = 1.4826 * np.median(np.abs(border - background[...,None]), axis=-1)
+        signal = windows - background[...,None,None]
+
+        ## the brightest pixel, kept off the window edge so that it has both neighbours
+        size = windows.shape[-1]
+        inner = signal[..., 1:-1, 1:-1].reshape(signal.shape[:-2] + (-1,))
+        brightest = np.argmax(inner, axis=-1)
+        pr, pc = brightest // (size-2) + 1, brightest % (size-2) + 1
+        def pixel(dr, dc):
+            flat = signal.reshape(signal.shape[:-2] + (-1,))
+            return np.take_along_axis(flat, ((pr+dr)*size + pc+dc)[...,None], axis=-1)[...,0]
+        peak = pixel(0, 0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            def vertex(minus, plus):
+                lm, l0, lp = np.log(minus), np.log(peak), np.log(plus)
+                curvature = lm - 2*l0 + lp
+                return (lm - lp) / (2*curvature), np.sqrt(-1/curvature)
+            dc, sigma_cols = vertex(pixel(0, -1), pixel(0, 1))
+            dr, sigma_rows = vertex(pixel(-1, 0), pixel(1, 0))
+        valid = ((peak > threshold_sigma*np.maximum(noise, np.median(noise))) & (np.abs(dc) <= 1) & (np.abs(dr) <= 1)
+                & np.isfinite(sigma_cols) & np.isfinite(sigma_rows))
+        h = (size-1)//2
+        return {'cols': self.origin_cols + pc - h + dc, 'rows': self.origin_rows + pr - h + dr,
+                'sigma_cols': sigma_cols, 'sigma_rows': sigma_rows, 'peak': peak, 'valid': valid}
+
+    def metrics(self, measurement, reference=None):
+        """
+        Per-frame summary of a measurement, with the line positions compared to a reference measurement (e.g. that of
+        the first frame), or to the predicted positions if none is given. Medians are used, so that occasional
+        blended or missing lines do not matter.
+        Output:
+            dict of scalars (or of 1D arrays over the frames): 'lines' (number of valid lines), 'shift_cols_px',
+            'shift_rows_px', 'shift_nm' (the wavelength error of the calibration, as given by the shift along the
+            dispersion), 'shift_rms_nm' (scatter of the line shifts),
+            'fwhm_nm' and 'resolving_power' (λ/FWHM)
+        """
+        ref_cols, ref_rows = (self.cols, self.rows) if reference is None else (reference['cols'], reference['rows'])
+        valid = measurement['valid'] & (True if reference is None else reference['valid'])
+        def masked_median(values):
+            return np.nanmedian(np.where(valid, values, np.nan), axis=-1)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)      ## all-NaN medians for frames with no valid lines
+            dcols = measurement['cols'] - ref_cols
+            shift = masked_median(dcols * self.dispersion)
+            fwhm = 2.3548 * measurement['sigma_cols'] * np.abs(self.dispersion)
+            return {'lines': np.sum(valid, axis=-1),
+                    'shift_cols_px': masked_median(dcols),
+                    'shift_rows_px': masked_median(measurement['rows'] - ref_rows),
+                    'shift_nm': shift*1e9,
+                    'shift_rms_nm': 1.4826*masked_median(np.abs(dcols*self.dispersion - np.asarray(shift)[...,None]))*1e9,
+                    'fwhm_nm': masked_median(fwhm)*1e9,
+                    'resolving_power': masked_median(self.wavelengths / fwhm)}
+
+
+metric_columns = [('lines', '{:6d}'), ('shift_cols_px', '{:13.3f}'), ('shift_rows_px', '{:13.3f}'), ('shift_nm', '{:9.4f}'),
+        ('shift_rms_nm', '{:12.4f}'), ('fwhm_nm', '{:8.4f}'), ('resolving_power', '{:15.0f}')]
+
+class DriftMonitor():
+    """
+    Measures the lines in each incoming image, against the first image (or against the predicted positions, if
+    `absolute`), and optionally appends the metrics to a log file. The tracker is set up on the first image.
+    Usage:
+        monitor = DriftMonitor(params, log_file_name='drift.dat')
+        metrics = monitor(image, timestamp)
+    """
+    def __init__(self, params, log_file_name=None, absolute=False, **tracker_kwargs):
+        self.params = params
+        self.log_file_name = log_file_name
+        self.absolute = absolute
+        self.tracker_kwargs = tracker_kwargs
+        self.tracker, self.reference = None, None
+        if log_file_name:
+            with open(log_file_name, 'a') as log_file:
+                log_file.write(self.header() + '\n')
+
+    @staticmethod
+    def header():
+        return '#timestamp          ' + '  '.join(key for key, fmt in metric_columns)
+
+    @staticmethod
+    def format(timestamp, metrics):
+        return '{:.3f}  '.format(timestamp) + '  '.join(fmt.format(metrics[key]) if np.isfinite(metrics[key]) else 
+                '{:>{}s}'.format('nan', len(key)) for key, fmt in metric_columns)
+
+    def __call__(self, image, timestamp=None):
+        if self.tracker is None or self.tracker.shape != image.shape:
+            self.tracker = LineTracker(self.params, image.shape, **self.tracker_kwargs)
+            self.reference = None
+        measurement = self.tracker.measure(image)
+        if self.reference is None and not self.absolute:
+            self.reference = measurement
+        metrics = self.tracker.metrics(measurement, self.reference)
+        if self.log_file_name:
+            with open(self.log_file_name, 'a') as log_file:
+                log_file.write(self.format(timestamp if timestamp is not None else time.time(), metrics) + '\n')
+        return metrics
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('inputs', nargs='+', help='glob patterns of RAW (*.cr2) images of the neon lamp, in time order')
+    parser.add_argument('-s', '--settings', default='./echelle_parameters.dat', help='echelle parameters file')
+    parser.add_argument('-d', '--decimate', type=int, default=4, help='decimate factor')
+    parser.add_argument('-o', '--output', default=None, help='also append the metrics to this file')
+    parser.add_argument('-w', '--halfwindow', type=int, default=4, help='half-width of the windows (px of the decimated image)')
+    parser.add_argument('--absolute', action='store_true', help='compare with the predicted positions instead of the first frame')
+    args = parser.parse_args()
+
+    params = echelle_process.complete_params(echelle_process.load_echelle_parameters(args.settings))
+    monitor = DriftMonitor(params, log_file_name=args.output, absolute=args.absolute, halfwindow_px=args.halfwindow)
+    print(monitor.header())
+    for raw_file_name in sorted(set(sum([glob.glob(pattern) for pattern in args.inputs], []))):
+        image = echelle_process.load_raw(raw_file_name, decimate_factor=args.decimate, params=params)
+        print(monitor.format(os.path.getmtime(raw_file_name), monitor(image, os.path.getmtime(raw_file_name))))
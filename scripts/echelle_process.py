@@ -0,0 +1,475 @@
+#!/usr/bin/python3
+#-*- coding: utf-8 -*-
+import numpy as np
+import collections
+import warnings
+from scipy import ndimage
+
+import instrumentation
+
+"""
+The λ-x-y conversion of an echelle image, separated from the GUI so that it can be used also by the hardware
+control scripts. See the docstring of gui_setup.py for the derivation of the equations.
+
+All functions take the echelle parameters as a plain dict `params`, keyed by the same names as `default_params`
+(i.e. as they are stored in the settings file), instead of querying the GUI sliders.
+
+The normalized sensor coordinates x, y ∈ (0 ... 1) run from left to right and from bottom to top, respectively.
+"""
+
+## Static settings & built-in constants
+cmos_aspect_ratio               = 16./24        ## for "APS-C"; change if using CMOS/CCD with different aspect
+aperture_halfwidth_px           = 3             ## in pixels of the (decimated) image; adjust if orders start to overlap
+bayer_mask                      = True          ## False for cameras with the Bayer colour filter scratched off the CMOS
+
+## Echelle processing parameters are accesible as sliders in the GUI, or via direct editing of the settings file
+default_params = collections.OrderedDict()
+default_params['first_order_number']	    =	   (-20,    4,      20)  # (range from, range to, initial value)
+default_params['last_order_number']	    =	   (-20,    16,     20)
+## Horizontal dispersion (blazed grating):
+default_params['Λ groove spacing (μm)']	    =	   (0,      13.333, 30)
+default_params['α incident angle (rad)']    =	   (-1,     .4,     1)
+default_params['ξ horizontal camera inclination (rad)'] = (-0,  .12, .2)
+default_params['F camera foc dist (mm)']    =	   (10,     84,     300)
+default_params['W camera CMOS width (mm)']  =	   (1,      24,     50)
+## Vertical dispersion (prism):
+default_params['κ vertical camera declination (rad)']	    =	   (1.4,   1.534, 1.55)      # TODO inclination/declination?
+default_params['prism_angle']	            =	   (-2,    -1.045, -1)
+default_params['prism_n0']	            =	   (1.3,    1.38, 1.4)
+default_params['prism_Sellmeyer_lambda0 (nm)']	=  (50,    180, 500)
+default_params['prism_Sellmeyer_F0']	    =	   (-0,    .252, .5)
+## Rotation of the whole image around its centre:
+default_params['θ image rotation (rad)']    =	   (-.1,    0,      .1)
+
+def load_echelle_parameters(settingsfilename='./echelle_parameters.dat'):
+    echelle_parameters = {}
+    try:
+        with open(settingsfilename) as settingsfile:
+            for n, line in enumerate(settingsfile.readlines()):
+                try:
+                    key, val = line.split('=', 1)
+                    echelle_parameters[key.strip()] = float(val)
+                except ValueError:
+                    print("Warning: could not process value `{}` for key `{}` in line #{} in `{}`".format(key, val, n, settingsfilename))
+    except IOError:
+        print("Warning: could not read `{}` in the working directory; using default values for image processing".format(settingsfilename))
+    return echelle_parameters
+
+def save_echelle_parameters(params, settingsfilename='./echelle_parameters.dat', verbose=True):
+    with open(settingsfilename, 'w') as of:
+        for key,val in params.items(): 
+            save_line = key + ' '*(40-len(key)) + ' = ' + str(val)
+            of.write(save_line+'\n')
+            if verbose:
+                print(save_line)
+
+def complete_params(echelle_parameters):
+    """ Returns a full parameter dict, taking the missing values from `default_params` """
+    return {key: float(echelle_parameters.get(key, item[1])) for key, item in default_params.items()}
+
+def order_numbers(params):
+    return np.arange(int(params['first_order_number']), int(params['last_order_number'])+1)
+
+
+## Geometrical transformations between the wavelength and the (x,y) position on the CMOS
+## All of them accept numpy arrays and broadcast `xx`/`ll` against `difrorder`
+def x_to_lambda(xx, difrorder, params):
+    grooved     = params['Λ groove spacing (μm)']       * 1e-6
+    iangle      = params['α incident angle (rad)']
+    cincli      = params['ξ horizontal camera inclination (rad)']
+    fdist       = params['F camera foc dist (mm)']      * 1e-3
+    cmosw       = params['W camera CMOS width (mm)']    * 1e-3
+    return grooved/difrorder*(np.sin(iangle)-np.sin((.5-xx)*cmosw/2/fdist - cincli))
+
+def lambda_to_x(ll, difrorder, params):
+    """ Exact inverse of x_to_lambda; returns NaN where the wavelength can not be diffracted into given order """
+    grooved     = params['Λ groove spacing (μm)']       * 1e-6
+    iangle      = params['α incident angle (rad)']
+    cincli      = params['ξ horizontal camera inclination (rad)']
+    fdist       = params['F camera foc dist (mm)']      * 1e-3
+    cmosw       = params['W camera CMOS width (mm)']    * 1e-3
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return .5 - (np.arcsin(np.sin(iangle) - ll*difrorder/grooved) + cincli) * 2*fdist/cmosw
+
+def lambda_to_y(ll, params):
+    def sellmeyer(l):
+        n0      = params['prism_n0']
+        lambda0 = params['prism_Sellmeyer_lambda0 (nm)']*1e-9
+        F0      = params['prism_Sellmeyer_F0']
+        n       = n0 + (F0*lambda0**-2/(lambda0**-2-l**-2))**.5
+        return n
+    def symmetricprism(l):
+        prism_angle = params['prism_angle']         # (rad)
+        n = sellmeyer(l)
+        return 2 * (np.arcsin(n * np.sin(prism_angle/2)) - prism_angle/2)   # refraction on a dispersive prism
+
+    cmosh =  params['W camera CMOS width (mm)'] * 1e-3  * cmos_aspect_ratio
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (params['κ vertical camera declination (rad)'] + symmetricprism(ll)) / cmosh * params['F camera foc dist (mm)']*1e-3
+
+def sensor_to_image(xx, yy, params):
+    """ Rotates the normalized sensor coordinates (as given by x_to_lambda and lambda_to_y) around the image centre """
+    theta = params['θ image rotation (rad)']
+    if theta == 0:
+        return xx, yy
+    u, v = (xx-.5), (yy-.5)*cmos_aspect_ratio        ## rotation is done in physical units, i.e. with square pixels
+    return (u*np.cos(theta) - v*np.sin(theta)) + .5, (u*np.sin(theta) + v*np.cos(theta))/cmos_aspect_ratio + .5
+
+
+## Loading of the images
+@instrumentation.timed('read_raw')
+def read_raw(raw_file_name):
+    """ 
+    Returns the visible RAW pixels (uint16), along with the black and saturation levels reported by the camera 
+    Input:
+        raw_file_name   - file name, or a file-like object (e.g. io.BytesIO with the data downloaded from the camera)
+    """
+    import rawpy
+    with rawpy.imread(raw_file_name) as raw:
+        return raw.raw_image_visible.copy(), float(np.mean(raw.black_level_per_channel)), float(raw.white_level)
+
+def block_size(decimate_factor, bayer=bayer_mask):
+    """ With the Bayer mask, odd factors are rounded up so that each block contains whole 2×2 cells of the mask """
+    return decimate_factor + (decimate_factor % 2 if bayer else 0)
+
+@instrumentation.timed('decimate')
+def decimate(npimage, decimate_factor=4, bayer=bayer_mask):
+    """ 
+    Averages blocks of decimate_factor × decimate_factor pixels; good is 2, 4, 8... less than 2 introduces
+    noise from Bayer mask residuals. The blocks are summed by reshaping the array into views, so that
+    no temporary array of the original size is created. Incomplete blocks at the bottom/right edge are dropped.
+    """
+    f = block_size(decimate_factor, bayer)
+    hb, wb = npimage.shape[0]//f, npimage.shape[1]//f
+    acc_dtype = np.uint32 if np.issubdtype(npimage.dtype, np.integer) else np.float32
+    rowsums = npimage[:hb*f].reshape(hb, f, -1).sum(axis=1, dtype=acc_dtype)
+    blocks = rowsums[:, :wb*f].reshape(hb, wb, f).sum(axis=2, dtype=acc_dtype).astype(np.float32)
+    blocks /= f*f
+    return blocks
+
+def order_band_rows(params, shape, halfwidth=aperture_halfwidth_px):
+    """ Returns (first row, last row + 1) of the image of given shape that the configured orders can reach """
+    table = trace_table(params, shape)
+    if not np.any(table.valid):
+        return 0, 0
+    rows = table.rowsf[table.valid]
+    return max(0, int(np.min(rows)) - halfwidth - 1), min(shape[0], int(np.ceil(np.max(rows))) + halfwidth + 1)
+
+@instrumentation.timed('preprocess_raw')
+def preprocess_raw(pixels, decimate_factor=4, params=None, bayer=bayer_mask, calibration=None, black_level=0.):
+    """ 
+    Pre-processing of the full-resolution RAW pixels, as decoded by load_raw
+    Input:
+        pixels          - 2D array of the visible RAW pixels (e.g. a view of the libraw buffer)
+        params          - if the echelle parameters are given, only the rows reachable by the orders are decimated;
+                          the rest of the image is left zero
+        calibration     - optional master dark/flat frames (calibration_frames.CalibrationFrames), applied to the
+                          full-resolution pixels before decimation; without the dark, the minimum value is subtracted
+        black_level     - subtracted before the master flat, if there is no master dark
+    Output:
+        2D float32 array
+    """
+    f = block_size(decimate_factor, bayer)
+    shape = (pixels.shape[0]//f, pixels.shape[1]//f)
+    first_row, last_row = order_band_rows(params, shape) if params is not None else (0, shape[0])
+    if last_row <= first_row:       ## no order reaches the image (e.g. with wrong parameters)
+        return np.zeros(shape, dtype=np.float32)
+    rows = slice(first_row*f, last_row*f)
+    if calibration is not None:
+        band = decimate(calibration.apply(pixels[rows], rows, black_level=black_level), f, bayer)
+    else:
+        band = decimate(pixels[rows], f, bayer)
+
+    ## without the master dark, subtract at least a constant background
+    if (calibration is None or calibration.dark is None) and band.size:
+        band -= np.min(band) 
+
+    if band.shape == shape:
+        return band
+    npimage = np.zeros(shape, dtype=band.dtype)
+    npimage[first_row:last_row] = band
+    return npimage 
+
+@instrumentation.timed('load_raw')
+def load_raw(raw_file_name, decimate_factor=4, params=None, bayer=bayer_mask, calibration=None):
+    """ 
+    Loading and pre-processing the RAW image (see preprocess_raw for the other arguments)
+    Input:
+        raw_file_name   - file name, or a file-like object (e.g. io.BytesIO with the data downloaded from the camera)
+    Output:
+        2D float32 array
+    """
+    import rawpy
+    with instrumentation.stage('rawpy_decode'):
+        raw = rawpy.imread(raw_file_name)
+        visible = raw.raw_image_visible     ## a view to the libraw buffer, decimated with no full-size copy
+    with raw:
+        return preprocess_raw(visible, decimate_factor=decimate_factor, params=params, bayer=bayer,
+                calibration=calibration, black_level=float(np.mean(raw.black_level_per_channel)))
+
+@instrumentation.timed('load_preview')
+def load_preview(file_data, max_px=1000):
+    """
+    Decodes a live-view frame for display, downsampled to at most `max_px` columns
+    Input:
+        file_data       - bytes of a JPEG preview image (summed over the colour channels), or of a RAW image
+    Output:
+        2D float32 array covering the whole sensor, as the image returned by load_raw
+    """
+    import io
+    if file_data[:2] == b'\xff\xd8':
+        import matplotlib.image
+        pixels = matplotlib.image.imread(io.BytesIO(file_data), format='jpeg')
+        if pixels.ndim == 3:
+            pixels = pixels.sum(axis=2, dtype=np.uint16)
+        step = int(np.ceil(pixels.shape[1] / max_px))
+        return decimate(pixels, step, bayer=False) if step > 1 else pixels.astype(np.float32)
+    import rawpy
+    with rawpy.imread(io.BytesIO(file_data)) as raw:
+        step = int(np.ceil(raw.raw_image_visible.shape[1] / max_px))
+    return load_raw(io.BytesIO(file_data), decimate_factor=step)
+
+
+## Tabulated order traces, computed once for each combination of parameters and image shape
+class TraceTable():
+    """
+    The (order, column) → (λ, y) table for all diffraction orders, evaluated in a single numpy call.
+
+    Attributes:
+        orders  - 1D array of diffraction order numbers
+        xs      - normalized sensor x-coordinate of each sample along the orders (the centre of each image column)
+        lambdas - 2D array (order × column) of wavelengths (m)
+        ys      - 2D array (order × column) of normalized sensor y-coordinates of the order trace
+        cols, rowsf - 2D arrays (order × column) of the trace position in (fractional) image pixels, after rotation;
+                  cols count from the pixel centres (as ndimage does), rowsf from the top edge of the image
+        valid   - 2D boolean array, True where the trace falls onto the image
+        rows    - 2D integer array of the image row nearest to the trace (0 where not valid)
+    """
+    @instrumentation.timed('trace_table')
+    def __init__(self, params, shape):
+        imheight, imwidth = shape
+        self.shape   = shape
+        self.theta   = params['θ image rotation (rad)']
+        self.orders  = order_numbers(params)
+        self.xs      = (np.arange(imwidth) + .5) / imwidth
+        with np.errstate(invalid='ignore', divide='ignore'):
+            self.lambdas = x_to_lambda(self.xs[np.newaxis,:], self.orders[:,np.newaxis], params)
+        self.ys      = lambda_to_y(self.lambdas, params)
+        imx, imy     = sensor_to_image(self.xs[np.newaxis,:], self.ys, params)
+        self.valid   = (imy > 0) & (imy < 1) & (imx >= 0) & (imx < 1)
+        self.cols    = np.where(self.valid, imx*imwidth - .5, 0)
+        self.rowsf   = (1.0 - np.where(self.valid, imy, 1)) * imheight
+        self.rows    = self.rowsf.astype(int)
+        self.columns = np.clip(np.rint(self.cols).astype(int), 0, imwidth-1)
+        self._stitcher = None
+
+    def stitcher(self):
+        """ The Stitcher for the orders of this table, built on the first use """
+        if self._stitcher is None:
+            self._stitcher = Stitcher(self.lambdas, self.valid)
+        return self._stitcher
+
+    def order_index(self, difrorder):
+        return int(difrorder - self.orders[0])
+
+    def spectrum_for_single_order(self, im, difrorder):
+        """ Samples the image at the nearest pixel below the trace, for each column where the trace is visible """
+        n = self.order_index(difrorder)
+        valid = self.valid[n]
+        return self.lambdas[n, valid], im[self.rows[n, valid], self.columns[n, valid]]
+
+    def rectified_orders(self, im, halfwidth=aperture_halfwidth_px):
+        """
+        Resamples all orders at once into a rectified array, using bilinear interpolation between the pixels.
+        Input:
+            im          - 2D image of the shape this table was computed for
+            halfwidth   - number of pixels taken on each side of the trace, perpendicular to the dispersion
+        Output:
+            3D array (order × column × cross-dispersion), NaN where the trace or the aperture leaves the image
+        """
+        offsets = np.arange(-halfwidth, halfwidth+1)
+        ## the perpendicular direction points "up" in the rotated frame; rows are counted from the top
+        rows = self.rowsf[:,:,np.newaxis] - .5 - offsets*np.cos(self.theta)
+        cols = self.cols[:,:,np.newaxis]       - offsets*np.sin(self.theta)
+        cube = ndimage.map_coordinates(im, [rows, cols], output=np.float32, order=1, 
+                mode='constant', cval=np.nan, prefilter=False)
+        cube[~self.valid] = np.nan
+        return cube
+
+def extract_cube(cube, method='aperture', readnoise=3.):
+    """
+    Reduces the rectified orders (order × column × cross-dispersion) into spectra (order × column).
+        method='aperture'   - plain sum over the aperture
+        method='optimal'    - variance-weighted sum with the mean cross-dispersion profile of each order (Horne 1986)
+    Pixels that fell off the image are not counted; the sum is rescaled to the full aperture width.
+    """
+    npix = cube.shape[2]
+    with np.errstate(invalid='ignore', divide='ignore'), warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)     ## all-NaN slices are expected outside of the image
+        aperture = np.nanmean(cube, axis=2) * npix
+        if method == 'aperture':
+            return aperture
+        elif method == 'optimal':
+            profile = np.nanmedian(cube / aperture[:,:,np.newaxis], axis=1, keepdims=True)
+            profile = np.clip(np.nan_to_num(profile), 0, None)
+            profile /= np.sum(profile, axis=2, keepdims=True)
+            variance = readnoise**2 + np.clip(profile*aperture[:,:,np.newaxis], 0, None)
+            pixweight = np.where(np.isnan(cube), 0, profile/variance)
+            return np.nansum(pixweight*cube, axis=2) / np.sum(pixweight*profile, axis=2)
+        else:
+            raise ValueError("unknown extraction method `{}`".format(method))
+
+@instrumentation.timed('extract')
+def extract_orders(im, params, method='aperture', halfwidth=aperture_halfwidth_px):
+    """
+    Extracts the spectra of all diffraction orders from an image.
+    Output:
+        (table, intensities) - the TraceTable giving the wavelengths, and a 2D array (order × column) of intensities,
+                               NaN where the order is not visible
+    """
+    table = trace_table(params, im.shape)
+    if method == 'nearest':
+        intensities = np.where(table.valid, im[table.rows, table.columns], np.nan)
+    else:
+        intensities = extract_cube(table.rectified_orders(im, halfwidth), method=method)
+    return table, intensities
+
+def extract_spectra(im, params, method='aperture', halfwidth=aperture_halfwidth_px):
+    """
+    Extracts the spectra of all diffraction orders from an image.
+    Output:
+        (partial_lambdas, partial_intensities) - lists of 1D arrays for each order, as expected by composite_spectrum
+    """
+    table, intensities = extract_orders(im, params, method=method, halfwidth=halfwidth)
+    valid = table.valid & np.isfinite(intensities)
+    return [l[v] for l,v in zip(table.lambdas, valid)], [i[v] for i,v in zip(intensities, valid)]
+
+_trace_table_cache = collections.OrderedDict()
+_trace_table_cache_size = 8
+
+def params_hash(params):
+    return hash(tuple(sorted((key, float(val)) for key, val in params.items())))
+
+def trace_table(params, shape):
+    """ Returns a (cached) TraceTable; repeated calls with the same calibration and image shape are free """
+    key = (params_hash(params), tuple(shape))
+    if key in _trace_table_cache:
+        _trace_table_cache.move_to_end(key)
+    else:
+        _trace_table_cache[key] = TraceTable(params, shape)
+        if len(_trace_table_cache) > _trace_table_cache_size:
+            _trace_table_cache.popitem(last=False)
+    return _trace_table_cache[key]
+
+
+## Stitching of the orders into a single spectrum
+class Stitcher():
+    """
+    Averages the spectra of overlapping orders onto a common wavelength grid. 
+
+    The grid is uniform in log(λ), with the step matched to the finest dispersion found among the orders (i.e. no
+    resolution is lost), times `oversampling`. Each order only contributes to the grid points within its own
+    wavelength window, through linear interpolation weighted by a quasi-rectangular window for smooth stitching
+    at the spectral overlap. All this is precomputed into one sparse matrix, so that stitching a frame (or a batch
+    of frames sharing the same calibration) is a single matrix product.
+
+    Input:
+        lambdas     - 2D array (order × column) of wavelengths
+        valid       - 2D boolean array, True where the order is visible
+    Usage:
+        stitcher = Stitcher(table.lambdas, table.valid)
+        composite_intensity = stitcher(intensities)     ## intensities shaped (order × column) or (frame × order × column)
+        plot(stitcher.grid, composite_intensity)
+    """
+    @instrumentation.timed('stitcher_setup')
+    def __init__(self, lambdas, valid, oversampling=1.):
+        import scipy.sparse
+        self.in_shape = lambdas.shape
+        with np.errstate(invalid='ignore'):
+            visible = [np.nonzero(v & np.isfinite(l) & (l > 0))[0] for l, v in zip(lambdas, valid)]
+        orders = [(n, columns) for n, columns in enumerate(visible) if len(columns) > 1]
+        if not orders:
+            raise ValueError("no diffraction order with positive wavelengths is visible in the image")
+
+        ## grid step from the largest resolving power λ/Δλ of a single column
+        resolving_power = max(np.max(np.abs(lambdas[n,columns][1:] / np.diff(lambdas[n,columns]))) for n,columns in orders)
+        lmin = min(np.min(lambdas[n,columns]) for n,columns in orders)
+        lmax = max(np.max(lambdas[n,columns]) for n,columns in orders)
+        npoints = int(np.ceil(np.log(lmax/lmin) * resolving_power * oversampling)) + 1
+        self.grid = np.geomspace(lmin, lmax, npoints)
+
+        rows, cols, vals = [], [], []
+        for n, columns in orders:
+            order_lambda = lambdas[n, columns]
+            sort = np.argsort(order_lambda)
+            order_lambda, columns = order_lambda[sort], columns[sort]
+            lo = np.searchsorted(self.grid, order_lambda[0], side='left')
+            hi = np.searchsorted(self.grid, order_lambda[-1], side='right')
+            window = self.grid[lo:hi]
+
+            ## weighted averaging uses a quasi-rectangular window for smooth stitching at the spectral overlap
+            q = (window - order_lambda[0]) / (order_lambda[-1] - order_lambda[0])
+            weight_func = np.sin(np.clip(q, 0, 1)*np.pi)**.8
+
+            position = np.interp(window, order_lambda, np.arange(len(order_lambda)))
+            left = np.minimum(position.astype(int), len(order_lambda)-2)
+            frac = position - left
+            flat = n*self.in_shape[1] + columns
+            for index, coef in ((left, 1-frac), (left+1, frac)):
+                rows.append(np.arange(lo, hi))
+                cols.append(flat[index])
+                vals.append(weight_func*coef)
+        rows, cols, vals = np.concatenate(rows), np.concatenate(cols), np.concatenate(vals)
+
+        weight_sum = np.bincount(rows, weights=vals, minlength=npoints)
+        self.covered = weight_sum > 0
+        vals = np.divide(vals, weight_sum[rows], out=np.zeros_like(vals), where=weight_sum[rows] > 0)
+        self.matrix = scipy.sparse.csr_matrix((vals, (rows, cols)), shape=(npoints, np.prod(self.in_shape)))
+
+    @instrumentation.timed('stitch')
+    def __call__(self, intensities):
+        intensities = np.asarray(intensities, dtype=float)
+        batch_shape = intensities.shape[:-2]
+        flat = intensities.reshape(-1, np.prod(self.in_shape))
+        finite = np.isfinite(flat)
+        composite = (self.matrix @ np.where(finite, flat, 0).T).T
+        if not np.all(finite):      ## re-normalize the weights where some of the orders did not give a value
+            with np.errstate(invalid='ignore', divide='ignore'):
+                composite /= (self.matrix @ finite.T.astype(float)).T
+        composite[:, ~self.covered] = np.nan
+        return composite.reshape(batch_shape + (len(self.grid),))
+
+def composite_spectrum(partial_lambdas, partial_intensities):
+    """
+        For orders given as separate (ragged) arrays without their TraceTable; a new Stitcher is built at each call,
+        so repeated frames should rather go through extract_orders() and table.stitcher().
+        Input:
+            partial_lambdas     - list of arrays describing wavelength
+            partial_intensities - list of arrays describing the spectral intensity
+        Output:
+            (composite_lambda, composite_intensity) - the spectrum averaged from all orders on a common wavelength axis
+    """
+    ## the orders of different lengths are padded into a 2D (order × column) array
+    length = max(np.size(pl) for pl in partial_lambdas)
+    lambdas = np.full((len(partial_lambdas), length), np.nan)
+    intensities = np.full((len(partial_lambdas), length), np.nan)
+    for n, (pl, pi) in enumerate(zip(partial_lambdas, partial_intensities)):
+        lambdas[n, :np.size(pl)], intensities[n, :np.size(pi)] = pl, pi
+    stitcher = Stitcher(lambdas, np.isfinite(lambdas) & np.isfinite(intensities))
+    return stitcher.grid, stitcher(intensities)
+
+def img2spectrum(npimage, params, method='aperture'):
+    """ 
+    Input:  
+            npimage         - 2D numpy array containing the (decimated) image pixels, or a 3D array of such images
+            params          - echelle parameters, e.g. complete_params(load_echelle_parameters(...))
+    Output:
+            (wavelength, intensity) - two arrays describing the resulting spectrum (2D intensity for 3D input)
+    """
+    if np.ndim(npimage) == 3:
+        tables, intensities = zip(*[extract_orders(im, params, method=method) for im in npimage])
+        table, intensities = tables[0], np.array(intensities)
+    else:
+        table, intensities = extract_orders(npimage, params, method=method)
+    stitcher = table.stitcher()
+    return stitcher.grid, stitcher(intensities)
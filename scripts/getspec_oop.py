@@ -1,70 +1,154 @@
-#!/usr/bin/python3  
+#!/usr/bin/python3
 #-*- coding: utf-8 -*-
 
+"""
+Captures a RAW image from the camera and shows it; with --continuous, acquires spectra one after another,
+overlapping the camera download, RAW decoding, extraction and stitching (see acquisition.py).
+
+Usage:
+    ./getspec_oop.py                                        ## single image, shown for optical alignment
+    ./getspec_oop.py --continuous 100 -s gui_setup/echelle_settings.dat
+    ./getspec_oop.py --continuous 100 --replay '../image_logs/*.cr2'    ## benchmark without the camera
+    ./getspec_oop.py --bracket 1/500,1/100,1/20             ## high dynamic range from three shutter speeds
+    ./getspec_oop.py --continuous 0 --store ../spectra/run1 ## monitoring, until interrupted by Ctrl+C
+    ./getspec_oop.py --continuous 100 --profile             ## where the time goes, stage by stage
+    ./getspec_oop.py --continuous 0 --track drift.dat       ## drift of the neon lines during a long run
+"""
+
 ## Import common moduli
 
+import argparse
 import datetime
-import gphoto2 as gp
 import io
 import numpy as np
 import rawpy # because libraw is defunct as of 2024
 import time
 
-
-
-
-## -- capture raw image ---
-camera = gp.Camera()
-camera.init() # not needed?
-cfg = camera.get_config()
-
-cfg.get_child_by_name('imageformat').set_value('RAW 2')
-cfg.get_child_by_name('capturesizeclass').set_value('Full Image')
-cfg.get_child_by_name('shutterspeed').set_value('1/500') # typically '1' or '0.5' or '1/10' etc. according to menu, use: gphoto2 --list-all-config
-cfg.get_child_by_name('iso').set_value('100') # use '100', '200', '400', '800' or '1600' only for 350D
-camera.set_config(cfg)
-
-#name = datetime.datetime.now().strftime('%Y-%m-%d_%H%M%S') # unix-convenient date format (not exactly ISO8601)
-#a.save(name + '_rawdata.cr2') # for debug - save data
-
-camera_file = gp.check_result(gp.gp_camera_capture_preview(camera))
-file_data = gp.check_result(gp.gp_file_get_data_and_size(camera_file))
-
-#camera_file = gp.check_result(gp.gp_camera_capture_preview(camera))
-#file_data = gp.check_result(gp.gp_file_get_data_and_size(camera_file))
-
-camera.exit()
-
-
-
-## --- raw data exctraction from CR2 into a numpy array ---
-
-#name = '2024-04-29_142117' 
-#with rawpy.imread(name + '_rawdata.cr2') as raw: # debug only if camera not available
-with rawpy.imread(io.BytesIO(file_data)) as raw:  # saves no data on harddrive
-    # note that the obtained dtype is uint16, ranging up to 2**12 for canon 350D, 
-    # and that numpy does not check for under/overflows 
-    pixels = raw.raw_image_visible.copy() 
-
-
-## --- interactive plotting ---
-
-import matplotlib.pyplot as plt
-
-minclip = np.min(pixels[200:-200, 200:-200])
-
-pixels = np.clip(pixels, minclip, 1000000) - minclip
-pixels = (pixels/4096.)**.3
-
-print(np.min(pixels), np.max(pixels))
-plt.imshow(pixels, clim=(0, 1), cmap='inferno') #    vmin=-0.01, vmax=1
-plt.show()
-
-
-# ==== REMARKS ==== 
-#a = camera.capture_preview()  # alternate capture command, why? 
+import camera as cameras
+import acquisition
+import calibration_frames
+import drift_tracking
+import echelle_process
+import hdr
+import instrumentation
+import spectrum_store
+
+
+def capture_single(camera):
+    ## -- capture raw image ---
+    with camera:
+        #name = datetime.datetime.now().strftime('%Y-%m-%d_%H%M%S') # unix-convenient date format (not exactly ISO8601)
+        #a.save(name + '_rawdata.cr2') # for debug - save data
+        file_data = camera.capture()
+
+    ## --- raw data exctraction from CR2 into a numpy array ---
+    with rawpy.imread(io.BytesIO(file_data)) as raw:  # saves no data on harddrive
+        # note that the obtained dtype is uint16, ranging up to 2**12 for canon 350D,
+        # and that numpy does not check for under/overflows
+        pixels = raw.raw_image_visible.copy()
+    return pixels
+
+def capture_bracket(camera, shutterspeeds):
+    with camera:
+        bracket = hdr.capture_bracket(camera, shutterspeeds)
+    return hdr.merge_raw_data(bracket)
+
+def show_image(pixels, full_scale=4096., calibration=None):
+    ## --- interactive plotting ---
+    import matplotlib.pyplot as plt
+
+    minclip = np.min(pixels[200:-200, 200:-200])
+    if calibration is not None:     ## master dark/flat frames, see calibration_frames.py
+        pixels = calibration.apply(pixels, black_level=minclip)     ## the minimum is used only if there is no dark
+        minclip = 0
+
+    pixels = np.clip(pixels, minclip, None) - minclip
+    pixels = (pixels/full_scale)**.3
+
+    print(np.min(pixels), np.max(pixels))
+    plt.imshow(pixels, clim=(0, 1), cmap='inferno') #    vmin=-0.01, vmax=1
+    plt.show()
+
+def acquire_continuous(camera, params, n_frames, decimate_factor=4, bracket=None, calibration=None, store_dir=None,
+        track_file_name=None):
+    store = None
+    monitor = drift_tracking.DriftMonitor(params, log_file_name=track_file_name) if track_file_name else None
+    def track(frame):
+        frame.drift = monitor(frame.image, frame.timestamp)
+    def on_spectrum(frame):
+        nonlocal store
+        wavelength, intensity = frame.spectrum
+        if store_dir:
+            if store is None:
+                store = spectrum_store.SpectrumStore(store_dir, grid=wavelength, params=params)
+            shutterspeed = frame.settings.get('shutterspeed')
+            store.append(intensity, frame.timestamp, wavelength=wavelength, index=frame.index,
+                    exposure=hdr.exposure_seconds(shutterspeed) if shutterspeed and not bracket else np.nan,
+                    iso=float(frame.settings.get('iso', 'nan')))
+        print("{:5d}  {}  {:.1f}-{:.1f} nm  max. intensity {:.4g}".format(frame.index,
+                datetime.datetime.fromtimestamp(frame.timestamp).strftime('%H:%M:%S.%f')[:-3],
+                np.nanmin(wavelength)*1e9, np.nanmax(wavelength)*1e9, np.nanmax(intensity)) + 
+                ("  drift {:.4f} nm, λ/Δλ {:.0f}".format(frame.drift['shift_nm'], frame.drift['resolving_power']) 
+                        if monitor else ''))
+    pipeline = acquisition.Pipeline(camera, params, decimate_factor=decimate_factor, bracket=bracket,
+            calibration=calibration)
+    if monitor:
+        pipeline.stages.append(('track', track))
+    try:
+        pipeline.run(n_frames, on_spectrum=on_spectrum)
+    except KeyboardInterrupt:
+        pipeline.stop()
+    finally:
+        if store is not None:
+            store.close()
+    print(pipeline.report())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('-c', '--continuous', type=int, default=None, metavar='N',
+            help='acquire N spectra (0 for no limit) instead of showing a single image')
+    parser.add_argument('-r', '--replay', default=None, metavar='GLOB',
+            help='use saved RAW files instead of the camera')
+    parser.add_argument('-s', '--settings', default='./echelle_parameters.dat', help='echelle parameters file')
+    parser.add_argument('--shutterspeed', default='1/500', help="typically '1' or '0.5' or '1/10' etc., see gphoto2 --list-all-config")
+    parser.add_argument('--iso', default='100', help="use '100', '200', '400', '800' or '1600' only for 350D")
+    parser.add_argument('-b', '--bracket', default=None, metavar='SPEEDS',
+            help="comma-separated shutter speeds to be merged into one HDR image, e.g. '1/500,1/100,1/20'")
+    parser.add_argument('--calibration', default=None, metavar='DIR',
+            help='directory with the master dark/flat frames (see calibration_frames.py)')
+    parser.add_argument('--store', default=None, metavar='DIR',
+            help='append the continuously acquired spectra to this store (see spectrum_store.py)')
+    parser.add_argument('--track', default=None, metavar='FILE',
+            help='measure the drift of the neon lines in each frame, and append it to FILE (see drift_tracking.py)')
+    parser.add_argument('--profile', nargs='?', const='-', default=None, metavar='FILE',
+            help='record the time and memory of each processing stage; report to stdout, or append to FILE')
+    args = parser.parse_args()
+    if args.profile:
+        instrumentation.enable(output=None if args.profile == '-' else args.profile)
+
+    if args.replay:
+        camera = cameras.ReplayCamera(args.replay, shutterspeed=args.shutterspeed, iso=args.iso)
+    else:
+        camera = cameras.GphotoCamera(shutterspeed=args.shutterspeed, iso=args.iso)
+
+    bracket = args.bracket.split(',') if args.bracket else None
+    calibration = calibration_frames.CalibrationFrames.load(args.calibration) if args.calibration else None
+
+    if args.continuous is None and bracket:
+        merged = capture_bracket(camera, bracket)
+        show_image(merged, full_scale=np.max(merged))
+    elif args.continuous is None:
+        show_image(capture_single(camera), calibration=calibration)
+    else:
+        params = echelle_process.complete_params(echelle_process.load_echelle_parameters(args.settings))
+        acquire_continuous(camera, params, args.continuous or None, bracket=bracket, calibration=calibration,
+                store_dir=args.store, track_file_name=args.track)
+
+
+# ==== REMARKS ====
+#a = camera.capture_preview()  # alternate capture command, why?
 
 # (todo:) disable "manual focus drive" somehow to prevent delays & fails ?
 # bash command with "--capture-tethered works perfectly" or fails randomly too ?
 #   suggest simple use case (w/ settings) on https://github.com/jim-easterbrook/python-gphoto2
-
@@ -3,11 +3,11 @@ import numpy as np
 import matplotlib
 import matplotlib.pyplot as plt
 import collections
-import time, sys
+import time, sys, os
+import concurrent.futures
 
 #from rawkit.raw import Raw
 #from rawkit.options import interpolation
-import rawpy
 from scipy import ndimage
 
 """
@@ -35,21 +35,27 @@ Derivation of the equations used:
       where α, β are the angles of incident and diffracted rays.
 
       TODO: Take into account also the vertical inclination due to previous passing through the prism.
-      TODO2: Allow for image rotattion!
-      TODO3: Could this be speeded up? https://stackoverflow.com/questions/7878398/how-to-extract-an-arbitrary-line-of-values-from-a-numpy-array
+      Image rotation is accounted for by the 'θ image rotation (rad)' parameter, and all orders are extracted at once
+      by interpolating the image into a rectified (order × column × cross-dispersion) array, see ../echelle_process.py
 
     * Normalized coordinate in the middle of the sensor X = 0.5 corresponds to β = -ξ, and more generally, 
       any coordinate on sensor X ∈ {0...1} corresponds to the angle ξ of a diffracted ray as β = (0.5-X) × W / 2F  -  ξ
     * Thus we express the wavelength as
                                  λ = Λ/M × [sin α - sin((0.5-X) × W / 2F  -  ξ)]
      
+Usage:
+    ./gui_setup.py                                      ## tuning the parameters on the default image
+    ./gui_setup.py ../../image_logs/neon.cr2            ## ... or on any other RAW image
+    ./gui_setup.py --live                               ## live view from the camera, for the optical alignment
+    ./gui_setup.py --live --replay '../../image_logs/preview_*.jpg'     ## the same with recorded frames
+
 TODOs:
 
     * interpolate to a single spectral curve
     * rewrite all func to avoid global variables
 
     integration with hardware:
-        move the actual λ-x-y conversion and into a separate module: echelle_process.py
+        the actual λ-x-y conversion has been moved into a separate module: ../echelle_process.py
 
     improvements:
         HDR data composition
@@ -59,73 +65,38 @@ TODOs:
 """
 ## Static settings & built-in constants
 vertical_convolution_length_px  = 30           ## adjust if orders start to overlap (e.g. with higher blazing angle)
-cmos_aspect_ratio               = 16./24        ## for "APS-C"; change if using CMOS/CCD with different aspect
 decimate_factor                 = 4             ## good is 2, 4, 8... less than 2 introduces noise from Bayer mask residuals
+extraction_method               = 'aperture'    ## 'nearest' pixel, 'aperture' sum or 'optimal' weighted sum across the order
+preview_max_px                  = 1000          ## the image shown in the GUI is further downsampled to this width
+debounce_ms                     = 150           ## spectra are re-extracted only after the slider rests for this time
+reference_lines_file            = 'neon-nist-cropped.dat'   ## any of the files in ../../spectral_data/
+live_poll_ms                    = 30            ## in the live view, new frames are checked for this often
 
 
 ## Loading and access to the previously saved image processing parameters
-## Echelle processing parameters are accesible as sliders in the GUI, or via direct editing of the settings file
-default_params = collections.OrderedDict()
-default_params['first_order_number']	    =	   (-20,    4,      20)  # (range from, range to, initial value)
-default_params['last_order_number']	    =	   (-20,    16,     20)
-## Horizontal dispersion (blazed grating):
-default_params['Λ groove spacing (μm)']	    =	   (0,      13.333, 30)
-default_params['α incident angle (rad)']    =	   (-1,     .4,     1)
-default_params['ξ horizontal camera inclination (rad)'] = (-0,  .12, .2)
-default_params['F camera foc dist (mm)']    =	   (10,     84,     300)
-default_params['W camera CMOS width (mm)']  =	   (1,      24,     50)
-## Vertical dispersion (prism):
-default_params['κ vertical camera declination (rad)']	    =	   (1.4,   1.534, 1.55)      # TODO inclination/declination? 
-default_params['prism_angle']	            =	   (-2,    -1.045, -1)
-default_params['prism_n0']	            =	   (1.3,    1.38, 1.4)
-default_params['prism_Sellmeyer_lambda0 (nm)']	=  (50,    180, 500)
-default_params['prism_Sellmeyer_F0']	    =	   (-0,    .252, .5)
-
-def load_echelle_parameters(settingsfilename='./echelle_parameters.dat'):
-    echelle_parameters = {}
-    try:
-        with open(settingsfilename) as settingsfile:
-            for n, line in enumerate(settingsfile.readlines()):
-                try:
-                    key, val = line.split('=', 1)
-                    echelle_parameters[key.strip()] = float(val)
-                except ValueError:
-                    print("Warning: could not process value `{}` for key `{}` in line #{} in `{}`".format(key, val, n, settingsfilename))
-    except IOError:
-        print("Warning: could not read `{}` in the working directory; using default values for image processing".format(settingsfilename))
-    return echelle_parameters
+## (the default values, geometry incl. the sensor aspect ratio, and the cached trace tables are provided by echelle_process.py)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import echelle_process
+import instrumentation           ## timing statistics, enabled by the ECHELLE_PROFILE environment variable
+import line_catalog
+from echelle_process import default_params, load_echelle_parameters
 
 def p(pname):  ## FIXME non-interactive mode fails on 'echelle_parameters' is not defined
     return paramsliders[pname].val    if __name__ == '__main__'   else echelle_parameters[pname]
+
+def current_params():
+    return {key: p(key) for key in default_params}
         
 
 ## Geometrical transformations between the wavelength and the (x,y) position on the CMOS
 def x_to_lambda(xx, difrorder):
-    grooved     = p('Λ groove spacing (μm)')       * 1e-6
-    iangle      = p('α incident angle (rad)')
-    cincli      = p('ξ horizontal camera inclination (rad)')
-    fdist       = p('F camera foc dist (mm)')      * 1e-3
-    cmosw       = p('W camera CMOS width (mm)')    * 1e-3
-    return grooved/difrorder*(np.sin(iangle)-np.sin((.5-xx)*cmosw/2/fdist - cincli))
+    return echelle_process.x_to_lambda(xx, difrorder, current_params())
 
-def lambda_to_x(ll, difrorder): ## for x in (0 ... 1) numerical inversion of the function x_to_lambda 
-    x = np.linspace(0, 1, 20) 
-    return np.interp(ll, x_to_lambda(x, difrorder), x)
+def lambda_to_x(ll, difrorder): ## exact inversion of the function x_to_lambda 
+    return echelle_process.lambda_to_x(ll, difrorder, current_params())
 
 def lambda_to_y(ll):
-    def sellmeyer(l):
-        n0      = p('prism_n0') 
-        lambda0 = p('prism_Sellmeyer_lambda0 (nm)')*1e-9 
-        F0      = p('prism_Sellmeyer_F0')
-        n       = n0 + (F0*lambda0**-2/(lambda0**-2-l**-2))**.5
-        return n
-    def symmetricprism(l):
-        prism_angle = p('prism_angle')         # (rad)
-        n = sellmeyer(l)
-        return 2 * (np.arcsin(n * np.sin(prism_angle/2)) - prism_angle/2)   # refraction on a dispersive prism
-
-    cmosh =  p('W camera CMOS width (mm)') * 1e-3  * cmos_aspect_ratio 
-    return (p('κ vertical camera declination (rad)') + symmetricprism(ll)) / cmosh * p('F camera foc dist (mm)')*1e-3
+    return echelle_process.lambda_to_y(ll, current_params())
 
 
 def load_raw_with_RawKit(raw_file_name): # old way - defunct
@@ -152,30 +123,9 @@ def load_raw_with_RawKit(raw_file_name): # old way - defunct
 
     return npimage 
 
-def load_raw(raw_file_name): # old way - defunct
+def load_raw(raw_file_name):
     """ Loading and pre-processing the RAW image """
-
-    with rawpy.imread(raw_file_name) as raw:
-        #npimage = raw.postprocess()
-        npimage = raw.raw_image_visible.copy()
-        print(type(npimage))
-        print(npimage)
-        print(npimage.shape)
-    ## vertical convolution to reduce noise (taking advantage of the multi-megapixel image)
-    #vertical_averaging_kernel = np.outer(np.e**(-np.linspace(-1,1,vertical_convolution_length_px)**2),np.array([1]))
-    #FIXME: array has incorrect shape
-    #vertical_averaging_kernel = np.outer(np.sin(-np.linspace(0,np.pi,vertical_convolution_length_px)**.5),np.array([1]))
-    #npimage = ndimage.convolve(npimage, vertical_averaging_kernel/np.sum(vertical_averaging_kernel)) 
-
-    ## optional: decimate data for faster processing
-    print(npimage.shape)
-    npimage = ndimage.convolve(npimage, np.ones([decimate_factor,decimate_factor])/decimate_factor**2)
-    npimage = npimage[::decimate_factor,::decimate_factor]
-
-    ## optional: subtract constant background #TODO  should subtract known "black frame"
-    npimage -= np.min(npimage) 
-
-    return npimage 
+    return echelle_process.load_raw(raw_file_name, decimate_factor=decimate_factor)
 
 def load_ppm(file_name):
     import imageio
@@ -188,101 +138,151 @@ def load_ppm(file_name):
 
 ## Actual analysis of the image
 def spectrum_for_single_order(im, difrorder):
-    single_lambdas = []
-    single_intensity = []
-    imheight, imwidth = im.shape
-    for xpixel in range(imwidth):
-        l = x_to_lambda(xpixel/imwidth, difrorder)
-        y = lambda_to_y(l)
-        if y>0 and y<1:
-            ypixel = int((1.0-y) * imheight)
-            single_intensity.append(im[ypixel, xpixel])      
-            single_lambdas.append(l)
-    return single_lambdas, single_intensity
-
-def composite_spectrum(partial_lambdas, partial_intensities):
-    """
-        Input:
-            partial_lambdas     - list of arrays describing wavelength
-            partial_intensities - list of arrays describing the spectral intensity
-        Output:
-            (
-    """
-    composite_lambda    = np.linspace(min([np.min(pl) for pl in partial_lambdas]), 
-                max([np.max(pl) for pl in partial_lambdas]), 
-                sum(np.size(pl) for pl in partial_lambdas))
-    composite_intensity = np.zeros_like(composite_lambda)
-    composite_weight    = np.zeros_like(composite_lambda)
-    for partial_lambda, partial_intensity in zip(partial_lambdas, partial_intensities):
-        ## weighted averaging uses a quasi-rectangular window for smooth stitching at the spectral overlap
-        partial_lambda, partial_intensity = np.array(partial_lambda), np.array(partial_intensity)
-        q = (partial_lambda-np.min(partial_lambda)) / (np.max(partial_lambda) - np.min(partial_lambda))
-        weight_func     = np.sin(q*np.pi)**.8  *  (np.sign(q)+1)  *  (np.sign(1-q)+1) / 4
-
-        composite_intensity += np.interp(composite_lambda, partial_lambda, weight_func * partial_intensity)
-        composite_weight    += np.interp(composite_lambda, partial_lambda, weight_func                    )
-    return composite_lambda, composite_intensity/composite_weight
-
+    return echelle_process.trace_table(current_params(), im.shape).spectrum_for_single_order(im, difrorder)
 
+def spectra_for_all_orders(im):
+    return echelle_process.extract_spectra(im, current_params(), method=extraction_method)
 
-
-def img2spectrum(npimage=None, raw_file_name='../image_logs/output_debayered_.1s_ISO100_.cr2'):
+def img2spectrum(npimage=None, raw_file_name='../image_logs/output_debayered_.1s_ISO100_.cr2', params=None):
     """ 
     Input:  
             npimage         - 2D numpy array containing the image pixels
             raw_file_name   - if no `npimage` is provided, the image can be loaded from this file
+            params          - echelle parameters; if not provided, they are loaded from the settings file
     Output:
             (wavelength, intensity) - two tuples describing the resulting spectrum
     """
-    echelle_parameters  = load_echelle_parameters()
-    if not npimage: npimage = load_raw(raw_file_name) # needed ???
-    partial_lambdas, partial_intensities = ([], [])
-    for difrorder in range(int(p('first_order_number')), int(p('last_order_number')+1)):
-        partial_lambdas.append(plot_lambdas)
-        partial_intensities.append(plot_intensity)
-    return composite_spectrum(partial_lambdas, partial_intensities)
+    if params is None: params = echelle_process.complete_params(load_echelle_parameters())
+    if npimage is None: npimage = load_raw(raw_file_name)
+    return echelle_process.img2spectrum(npimage, params, method=extraction_method)
 
 
 
 if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Interactive tuning of the echelle parameters')
+    parser.add_argument('raw_file_name', nargs='?', default='../image_logs/output_debayered_.1s_ISO100_.cr2')
+    parser.add_argument('--live', action='store_true', help='show the live view of the camera instead of a static image')
+    parser.add_argument('--replay', default=None, metavar='GLOB', help='recorded frames standing in for the camera')
+    parser.add_argument('--shutterspeed', default='1/500')
+    parser.add_argument('--iso', default='100')
+    args = parser.parse_args()
+
     ## GUI user interaction
     fig, (ax1, ax2) = plt.subplots(1,2)
-    fig.subplots_adjust(left=0.05, right=0.95, bottom=0.30, top=0.99, hspace=0)
+    fig.subplots_adjust(left=0.05, right=0.95, bottom=0.32, top=0.99, hspace=0)
 
     echelle_parameters  = load_echelle_parameters()
-    npimage = load_raw('../image_logs/output_debayered_.1s_ISO100_.cr2')
+    if args.live:
+        import camera as cameras
+        camera = (cameras.ReplayCamera(args.replay, shutterspeed=args.shutterspeed, iso=args.iso) if args.replay else
+                cameras.GphotoCamera(shutterspeed=args.shutterspeed, iso=args.iso)).open()
+        npimage = echelle_process.load_preview(camera.capture_preview(), max_px=preview_max_px)
+    else:
+        npimage = load_raw(args.raw_file_name)
     #npimage = load_ppm('../image_logs/output-test0100ms.ppm')
 
 
 
     ## GUI: update plots on manual parameter tuning
-    def update(val): 
-        partial_lambdas, partial_intensities = ([], [])
+    ## The order traces and peak markers are cheap; they are redrawn at once by blitting over the cached image. 
+    ## The extraction of spectra is slow; it waits until the slider rests, runs in a background thread, and if the 
+    ## parameters change meanwhile, only the most recent ones are extracted next.
+    horizontal_keys = {'Λ groove spacing (μm)', 'α incident angle (rad)', 'ξ horizontal camera inclination (rad)', 
+            'F camera foc dist (mm)', 'W camera CMOS width (mm)', 'first_order_number', 'last_order_number'}
+    vertical_keys = {'κ vertical camera declination (rad)', 'prism_angle', 'prism_n0', 'prism_Sellmeyer_lambda0 (nm)',
+            'prism_Sellmeyer_F0', 'F camera foc dist (mm)', 'W camera CMOS width (mm)'}
+    overlay_cache = {'params': {}, 'xs': {}, 'ys': {}}
+
+    @instrumentation.timed('gui_overlay')
+    def update_overlay(params):
+        changed = {key for key in params if params[key] != overlay_cache['params'].get(key)}
+        overlay_cache['params'] = params
+        def to_image(xx, yy): return echelle_process.sensor_to_image(xx, yy, params)
+        peak_sets = (('major', spectral_peaks_major, peaks_major), ('midi', spectral_peaks_midi, peaks_midi), 
+                ('minor', spectral_peaks_minor, peaks_minor))
+        if changed & vertical_keys:
+            for name, peaks, markers in peak_sets:
+                overlay_cache['ys'][name] = lambda_to_y(peaks)
         for lineindex, difrorder in enumerate(range(int(p('first_order_number')), int(p('last_order_number')+1))):
             x = np.linspace(0, 1, 20) 
             yy = lambda_to_y(x_to_lambda(x, difrorder))
-            lines[lineindex].set_data(x, yy)
+            lines[lineindex].set_data(*to_image(x, yy))
 
             ## update spectral peaks      ## TODO make more general
-            major_xs, major_ys = lambda_to_x(spectral_peaks_major, difrorder), lambda_to_y(spectral_peaks_major)
-            peaks_major[lineindex].set_data(major_xs, major_ys)
-
-            midi_xs, midi_ys = lambda_to_x(spectral_peaks_midi, difrorder), lambda_to_y(spectral_peaks_midi)
-            peaks_midi[lineindex].set_data(midi_xs, midi_ys)
-
-            minor_xs, minor_ys = lambda_to_x(spectral_peaks_minor, difrorder), lambda_to_y(spectral_peaks_minor)
-            peaks_minor[lineindex].set_data(minor_xs, minor_ys)
-
-
-            plot_lambdas, plot_intensity = spectrum_for_single_order(npimage, difrorder)
-            partial_lambdas.append(plot_lambdas)
-            partial_intensities.append(plot_intensity)
+            for name, peaks, markers in peak_sets:
+                if changed & horizontal_keys:
+                    overlay_cache['xs'][name, difrorder] = lambda_to_x(peaks, difrorder)
+                markers[lineindex].set_data(*to_image(overlay_cache['xs'][name, difrorder], overlay_cache['ys'][name]))
+        return changed
+
+    @instrumentation.timed('gui_update_spectra')
+    def update_spectra(spectra):
+        partial_lambdas, partial_intensities, cl, ci = spectra
+        for lineindex, (plot_lambdas, plot_intensity) in enumerate(zip(partial_lambdas, partial_intensities)):
             spectral_curves[lineindex].set_data(np.array(plot_lambdas)*1e9, np.array(plot_intensity))
-
-        cl, ci = composite_spectrum(partial_lambdas, partial_intensities)
         composite_curve.set_data(np.array(cl)*1e9, ci)
 
-        fig.canvas.draw_idle()
+    @instrumentation.timed('gui_extract')
+    def extract(params):
+        table, intensities = echelle_process.extract_orders(npimage, params, method=extraction_method)
+        valid = table.valid & np.isfinite(intensities)
+        stitcher = table.stitcher()     ## cached with the table, i.e. reused while the parameters do not change
+        return ([l[v] for l,v in zip(table.lambdas, valid)], [i[v] for i,v in zip(intensities, valid)],
+                stitcher.grid, stitcher(intensities))
+
+    extraction_worker = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    extraction_state = {'future': None, 'pending': None}
+    def start_extraction():
+        if extraction_state['future'] is None and extraction_state['pending'] is not None:
+            extraction_state['future'] = extraction_worker.submit(extract, extraction_state['pending'])
+            extraction_state['pending'] = None
+
+    def check_extraction():
+        future = extraction_state['future']
+        if future is not None and future.done():
+            extraction_state['future'] = None
+            try:
+                update_spectra(future.result())
+                fig.canvas.draw_idle()
+            except Exception as e:
+                print("Warning: could not extract the spectra: {}".format(e))
+            start_extraction()
+
+    ## GUI: blitting of the overlay and of the sliders, which are animated artists excluded from the full redraw;
+    ## their backgrounds are grabbed after each full redraw of the figure (e.g. when the spectra are updated)
+    blit_state = {'backgrounds': {}}
+    def overlay_artists(): return ([im] if args.live else []) + lines + peaks_major + peaks_midi + peaks_minor
+    def slider_bbox(key):
+        bbox = paramsliders[key].ax.bbox
+        return matplotlib.transforms.Bbox([[fig.bbox.x0, bbox.y0], [fig.bbox.x1, bbox.y1]])
+    @instrumentation.timed('gui_redraw')
+    def on_draw(event):
+        if fig.canvas.supports_blit:
+            blit_state['backgrounds'] = {key: fig.canvas.copy_from_bbox(slider_bbox(key)) for key in paramsliders}
+            blit_state['backgrounds'][None] = fig.canvas.copy_from_bbox(ax1.bbox)
+        for artist in overlay_artists(): ax1.draw_artist(artist)
+        for slider in paramsliders.values(): fig.draw_artist(slider.ax)
+    @instrumentation.timed('gui_blit')
+    def blit_overlay(changed_keys):
+        if not blit_state['backgrounds']:
+            fig.canvas.draw_idle()
+            return
+        fig.canvas.restore_region(blit_state['backgrounds'][None])
+        for artist in overlay_artists(): ax1.draw_artist(artist)
+        fig.canvas.blit(ax1.bbox)
+        for key in changed_keys:
+            fig.canvas.restore_region(blit_state['backgrounds'][key])
+            fig.draw_artist(paramsliders[key].ax)
+            fig.canvas.blit(slider_bbox(key))
+
+    def update(val): 
+        params = current_params()
+        changed_keys = update_overlay(params)
+        blit_overlay(changed_keys)
+        extraction_state['pending'] = params
+        debounce_timer.stop()
+        debounce_timer.start()
 
 
     ## GUI: Known spectral peaks for neon lamp 
@@ -304,48 +304,120 @@ if __name__ == '__main__':
                 key, item[0], item[2], 
                 valinit=echelle_parameters.get(key.strip(), item[1]))
         paramsliders[key].on_changed(update)
+        paramsliders[key].drawon = False                ## redrawn by blitting in update()
+        paramsliders[key].ax.set_animated(True)
         sliderpos += sliderheight*1.4 if key in ('x_to_lambda_ofs','κ vertical camera declination (rad)') else sliderheight
 
     ## GUI: Option to save current parameter values
     def save_values(event): 
-        with open('echelle_settings.dat', 'w') as of:
-            for key,item in paramsliders.items(): 
-                save_line = key + ' '*(40-len(key)) + ' = ' + str(item.val)
-                of.write(save_line+'\n')
-                print(save_line)
+        echelle_process.save_echelle_parameters({key:item.val for key,item in paramsliders.items()}, 'echelle_settings.dat')
     button = matplotlib.widgets.Button(plt.axes([.8, 0.02, 0.1, sliderheight]), 'Save settings', color='.7', hovercolor='.9')
     button.on_clicked(save_values)
 
-
-    ## GUI: plotting the RAW image ## TODO employ the Actor class in matplotlib to make updates more responsive
-    im = ax1.imshow(np.log10(npimage+np.max(npimage)/1e0), extent=[0,1,0,1], cmap=matplotlib.cm.Greys_r)
-    #im = ax1.imshow(np.log10(npimage+np.max(npimage)/1e5), extent=[0,1,0,1], cmap=matplotlib.cm.Greys_r)
+    ## GUI: Option to fit the parameters automatically to the lines of a neon lamp
+    def autocalibrate_values(event): 
+        import autocalibrate
+        try:
+            params, report = autocalibrate.calibrate(npimage, current_params())
+        except ValueError as e:
+            print("Warning: automatic calibration failed: {}".format(e))
+            return
+        autocalibrate.print_report(report)
+        for key in autocalibrate.fit_keys:      ## incl. the ξ and κ offsets of the coarse alignment
+            paramsliders[key].set_val(params[key])
+    calbutton = matplotlib.widgets.Button(plt.axes([.68, 0.02, 0.1, sliderheight]), 'Auto-calibrate', color='.7', hovercolor='.9')
+    calbutton.on_clicked(autocalibrate_values)
+
+
+    ## GUI: plotting the RAW image, downsampled to roughly the screen resolution
+    preview_step = int(np.ceil(npimage.shape[1] / preview_max_px))
+    preview = echelle_process.decimate(npimage, preview_step, bayer=False) if preview_step > 1 else npimage
+    def display_scale(image): return np.log10(image+np.max(image)/1e0)
+    im = ax1.imshow(display_scale(preview), extent=[0,1,0,1], cmap=matplotlib.cm.Greys_r)
+    #im = ax1.imshow(np.log10(preview+np.max(preview)/1e5), extent=[0,1,0,1], cmap=matplotlib.cm.Greys_r)
 
     ## GUI: Prepare (empty) matplotlib curve objects for plotting the diffraction orders and spectra
     lines, peaks_major, peaks_midi, peaks_minor, spectral_curves = ([], [], [], [], [])
     for difrorder in range(int(p('first_order_number')), int(p('last_order_number')+1)):
-        leftpanelline = ax1.plot([], [], lw=1, ls='--' if difrorder==1 else '-')[0]
+        leftpanelline = ax1.plot([], [], lw=1, ls='--' if difrorder==1 else '-', animated=True)[0]
         color=leftpanelline.get_color()
         lines.append(leftpanelline) 
-        peaks_major.append(ax1.plot([], [], marker='D', lw=0, markersize=8, markeredgecolor=color, markerfacecolor='none')[0])
-        peaks_midi.append(ax1.plot([], [], marker='D', lw=0, markersize=6, markeredgecolor=color, markerfacecolor='none',alpha=.6)[0])
-        peaks_minor.append(ax1.plot([], [], marker='D', lw=0, markersize=4, markeredgecolor=color, markerfacecolor='none',alpha=.4)[0])
+        peaks_major.append(ax1.plot([], [], marker='D', lw=0, markersize=8, markeredgecolor=color, markerfacecolor='none', animated=True)[0])
+        peaks_midi.append(ax1.plot([], [], marker='D', lw=0, markersize=6, markeredgecolor=color, markerfacecolor='none',alpha=.6, animated=True)[0])
+        peaks_minor.append(ax1.plot([], [], marker='D', lw=0, markersize=4, markeredgecolor=color, markerfacecolor='none',alpha=.4, animated=True)[0])
         spectral_curves.append(ax2.plot([], [], lw=1.5, alpha=.8, color=color)[0])
         composite_curve = ax2.plot([], [], lw=2, color='k')[0]
-    update(None)
+    update_overlay(current_params())
+    update_spectra(extract(current_params()))
+
+    fig.canvas.mpl_connect('draw_event', on_draw)
+    debounce_timer = fig.canvas.new_timer(interval=debounce_ms)
+    debounce_timer.single_shot = True
+    debounce_timer.add_callback(start_extraction)
+    poll_timer = fig.canvas.new_timer(interval=50)
+    poll_timer.add_callback(check_extraction)
+    poll_timer.start()
+
+    ## GUI: Live view; the camera session stays open, and the preview frames are pulled in a background thread and
+    ## blitted under the overlay as soon as they arrive. The spectra are extracted from a full RAW image only, taken 
+    ## on request by the 'Capture RAW' button.
+    if args.live:
+        im.set_animated(True)
+        camera_worker = concurrent.futures.ThreadPoolExecutor(max_workers=1)    ## the camera is used from one thread
+        live_state = {'preview': None, 'raw': None}
+        def grab_preview():
+            return echelle_process.load_preview(camera.capture_preview(), max_px=preview_max_px)
+        def grab_raw():
+            import io
+            return load_raw(io.BytesIO(camera.capture()))
+
+        @instrumentation.timed('gui_live_frame')
+        def show_frame(frame):
+            scaled = display_scale(frame)
+            im.set_data(scaled)
+            im.set_clim(np.min(scaled), np.max(scaled))
+            blit_overlay(set())
+
+        def check_live():
+            global npimage
+            for kind in ('raw', 'preview'):
+                future = live_state[kind]
+                if future is None or not future.done():
+                    continue
+                live_state[kind] = None
+                try:
+                    frame = future.result()
+                except Exception as e:
+                    print("Warning: could not get the {} image from the camera: {}".format(kind, e))
+                    continue
+                if kind == 'raw':
+                    npimage = frame
+                    extraction_state['pending'] = current_params()
+                    start_extraction()
+                show_frame(frame)
+            if live_state['preview'] is None and live_state['raw'] is None:
+                live_state['preview'] = camera_worker.submit(grab_preview)
+        live_timer = fig.canvas.new_timer(interval=live_poll_ms)
+        live_timer.add_callback(check_live)
+        live_timer.start()
+
+        def capture_raw(event):
+            if live_state['raw'] is None:
+                live_state['raw'] = camera_worker.submit(grab_raw)
+        rawbutton = matplotlib.widgets.Button(plt.axes([.56, 0.02, 0.1, sliderheight]), 'Capture RAW', color='.7', hovercolor='.9')
+        rawbutton.on_clicked(capture_raw)
+        fig.canvas.mpl_connect('close_event', lambda event: camera_worker.submit(camera.close))
 
     ## GUI: In the right panel: Generate artificial neon spectrum for verification ## TODO make more general
     artif_x = np.linspace(300e-9, 1100e-9, 2000)
-    artif_y = np.zeros_like(artif_x) + 1
-    for peak in spectral_peaks_major: artif_y += np.exp(-(artif_x-peak)**2 * 1e9**2)*100
-    for peak in spectral_peaks_midi:  artif_y += np.exp(-(artif_x-peak)**2 * 1e9**2)*30
-    for peak in spectral_peaks_minor: artif_y += np.exp(-(artif_x-peak)**2 * 1e9**2)*10
+    artif_y = 1 + line_catalog.synthetic_spectrum(artif_x, 
+            np.concatenate([spectral_peaks_major, spectral_peaks_midi, spectral_peaks_minor]),
+            np.concatenate([np.full_like(spectral_peaks_major, 100), np.full_like(spectral_peaks_midi, 30), 
+                    np.full_like(spectral_peaks_minor, 10)]))
     ax2.plot(artif_x*1e9, artif_y, lw=.6, c='k', ls='-.')
 
-    artif_y = np.zeros_like(artif_x) + 1
-    wls,intenss = np.genfromtxt('../../spectral_data/neon-nist-cropped.dat', unpack=True)
-    for wl,intens in zip(wls,intenss): 
-        artif_y += np.exp(-(artif_x-wl/1e9)**2 * 1e9**2)*intens**3/1e10
+    wls, intenss = line_catalog.LineCatalog(reference_lines_file).range(artif_x[0], artif_x[-1])
+    artif_y = 1 + line_catalog.synthetic_spectrum(artif_x, wls, intenss**3/1e10)
     ax2.plot(artif_x*1e9, artif_y, lw=.6, c='k', ls='--')
 
     ax2.set_yscale('log')
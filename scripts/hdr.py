@@ -0,0 +1,83 @@
+#!/usr/bin/python3
+#-*- coding: utf-8 -*-
+
+"""
+Higher dynamic range by automatic weighted averaging of images taken with different shutter speeds.
+
+Each RAW image is converted to a linear, exposure-normalized signal (counts per second of exposure) and added to
+running weighted sums, so that only three full-resolution arrays are kept in memory regardless of the number of
+shutter speeds. The weight grows with the exposure time (longer exposures have a better signal-to-noise ratio)
+and drops to zero as the pixel approaches saturation. Pixels that are saturated in every image take the value
+from the shortest exposure.
+
+Usage:
+    accumulator = ExposureAccumulator()
+    for shutterspeed in ['1/500', '1/100', '1/20']:
+        camera.set_config(shutterspeed=shutterspeed)
+        accumulator.add(*echelle_process.read_raw(io.BytesIO(camera.capture())), exposure_seconds(shutterspeed))
+    npimage = echelle_process.decimate(accumulator.result())
+"""
+
+import fractions
+import io
+
+import numpy as np
+
+import echelle_process
+import instrumentation
+
+
+def exposure_seconds(shutterspeed):
+    """ Converts the gphoto2 shutter speed setting, like '1/500', '0.3' or '2', to seconds """
+    return float(fractions.Fraction(str(shutterspeed).strip().rstrip('s"')))
+
+class ExposureAccumulator():
+    """
+    Input:
+        knee            - fraction of the saturation level where the weight starts to drop linearly towards zero
+    """
+    def __init__(self, knee=.8):
+        self.knee = knee
+        self.weighted_sum = None
+        self.n_images = 0
+
+    def add(self, pixels, black_level, saturation_level, exposure):
+        """ Adds a single RAW image (as returned by echelle_process.read_raw) taken with `exposure` seconds """
+        signal = np.subtract(pixels, black_level, dtype=np.float32)
+        full_scale = saturation_level - black_level
+        weight = np.clip((1 - signal/full_scale) / (1 - self.knee), 0, 1)
+        weight *= exposure
+        signal /= exposure
+
+        if self.weighted_sum is None:
+            self.weighted_sum   = np.zeros_like(signal)
+            self.weight_sum     = np.zeros_like(signal)
+            self.shortest       = signal
+            self.shortest_exposure = exposure
+        elif exposure < self.shortest_exposure:
+            self.shortest, self.shortest_exposure = signal, exposure
+        self.weighted_sum += weight * signal
+        self.weight_sum   += weight
+        self.n_images += 1
+
+    def result(self):
+        """ Returns the merged image in counts per second """
+        saturated = self.weight_sum == 0
+        return np.divide(self.weighted_sum, self.weight_sum, out=self.shortest.copy(), where=~saturated)
+
+@instrumentation.timed('hdr_merge')
+def merge_raw_data(raw_data_with_exposures, knee=.8):
+    """ Merges a list of (RAW file data or name, exposure in seconds) pairs into one image, in counts per second """
+    accumulator = ExposureAccumulator(knee=knee)
+    for raw_data, exposure in raw_data_with_exposures:
+        raw_file = io.BytesIO(raw_data) if isinstance(raw_data, bytes) else raw_data
+        accumulator.add(*echelle_process.read_raw(raw_file), exposure)
+    return accumulator.result()
+
+def capture_bracket(camera, shutterspeeds):
+    """ Captures one RAW image for each shutter speed; returns the list of (RAW data, exposure in seconds) """
+    bracket = []
+    for shutterspeed in shutterspeeds:
+        camera.set_config(shutterspeed=shutterspeed)
+        bracket.append((camera.capture(), exposure_seconds(shutterspeed)))
+    return bracket
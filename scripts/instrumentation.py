@@ -0,0 +1,186 @@
+#!/usr/bin/python3
+#-*- coding: utf-8 -*-
+
+"""
+Optional timing and memory statistics of the processing stages, from the camera download to the stitching.
+
+The stages are marked in the code either as
+    with instrumentation.stage('decimate'):
+        ...
+or by decorating a function with @instrumentation.timed('extract'). While disabled (the default), a stage costs one
+global flag check. Once enabled, each stage records its call count, wall time and the peak memory allocated
+within it (numpy arrays included, as traced by tracemalloc); the statistics of the last `window` calls are
+reported periodically to stdout or appended to a file.
+
+Enabling:
+    instrumentation.enable(output='profile.log', interval=10)       ## from the code, or
+    ECHELLE_PROFILE=1 ./gui_setup.py                               ## for any script: 1 prints to stdout,
+    ECHELLE_PROFILE=profile.log ./getspec_oop.py --continuous 100  ## anything else is a file name
+
+Since tracemalloc is process-wide, its peak can only be reset at the start of a stage while no stage is running in
+another thread. Stages overlapping with others (as in acquisition.Pipeline) thus record the peak of the whole
+process since the last reset, including the memory of the other threads; their peaks are upper bounds.
+"""
+
+import atexit
+import collections
+import contextlib
+import functools
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+import numpy as np
+
+
+enabled = False
+_window = 100
+_memory = True
+_stats = {}
+_lock = threading.Lock()
+_local = threading.local()
+_active = 0         ## stages running in all threads, for the reset of the tracemalloc peak
+_exporter = None
+_output = None
+_atexit_registered = False
+
+
+class StageStats():
+    """ Running totals of one stage, and the wall times of its last `window` calls """
+    def __init__(self, window):
+        self.calls      = 0
+        self.total_time = 0.
+        self.recent     = collections.deque(maxlen=window)
+        self.peak_bytes = 0
+
+    def add(self, seconds, peak_bytes):
+        self.calls += 1
+        self.total_time += seconds
+        self.recent.append(seconds)
+        self.peak_bytes = max(self.peak_bytes, peak_bytes)
+
+
+class _Stage():
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        global _active
+        if _memory:
+            ## the peak is reset for each stage; an enclosing stage gets the inner peaks propagated in __exit__, but
+            ## the stages of other threads would lose theirs, so then the peak is kept
+            stack = _local.__dict__.setdefault('stack', [])
+            with _lock:
+                current, peak = tracemalloc.get_traced_memory()
+                if stack:
+                    stack[-1][1] = max(stack[-1][1], peak)
+                if _active == len(stack):
+                    tracemalloc.reset_peak()
+                _active += 1
+            self.start_bytes = current
+            stack.append([self, current])
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        global _active
+        seconds = time.perf_counter() - self.t0
+        peak_bytes = 0
+        with _lock:
+            if _memory:
+                stack = _local.stack
+                peak = max(tracemalloc.get_traced_memory()[1], stack.pop()[1])
+                if stack:
+                    stack[-1][1] = max(stack[-1][1], peak)
+                peak_bytes = peak - self.start_bytes
+                _active -= 1
+            if self.name not in _stats:
+                _stats[self.name] = StageStats(_window)
+            _stats[self.name].add(seconds, peak_bytes)
+        return False
+
+_disabled_stage = contextlib.nullcontext()
+
+def stage(name):
+    """ Context manager recording one call of the stage `name` """
+    return _Stage(name) if enabled else _disabled_stage
+
+def timed(name):
+    """ Decorator recording each call of the function as the stage `name` """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return function(*args, **kwargs)
+            with _Stage(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def report():
+    """ Table of all stages: calls, total time, mean and 95th percentile of the recent calls, and the peak memory """
+    with _lock:
+        items = [(name, s.calls, s.total_time, np.array(s.recent), s.peak_bytes) for name, s in _stats.items()]
+    lines = ['{:<20s} {:>7s} {:>9s} {:>9s} {:>9s} {:>9s}'.format('stage', 'calls', 'total(s)', 'mean(ms)', 'p95(ms)', 'peak(MB)')]
+    for name, calls, total_time, recent, peak_bytes in sorted(items, key=lambda item: -item[2]):
+        lines.append('{:<20s} {:7d} {:9.3f} {:9.2f} {:9.2f} {:9.1f}'.format(name, calls, total_time,
+                np.mean(recent)*1e3, np.percentile(recent, 95)*1e3, peak_bytes/2**20))
+    return '\n'.join(lines)
+
+def reset():
+    with _lock:
+        _stats.clear()
+
+def export(output=None):
+    """ Writes the report, with a timestamp, to the file `output` (appended), or to stdout """
+    text = '# {}\n{}\n'.format(time.strftime('%Y-%m-%d %H:%M:%S'), report())
+    if output:
+        with open(output, 'a') as output_file:
+            output_file.write(text)
+    else:
+        sys.stdout.write(text)
+        sys.stdout.flush()
+
+def enable(output=None, interval=10., window=100, memory=True):
+    """
+    Input:
+        output      - file name for the periodic reports, or None for stdout
+        interval    - seconds between the reports; None for no periodic reports (then call export() as needed)
+        window      - number of recent calls of each stage in the rolling statistics
+        memory      - if False, only the time is recorded, which avoids the overhead of tracemalloc
+    The last report is also written at the exit of the program.
+    """
+    global enabled, _window, _memory, _exporter, _output, _atexit_registered
+    _window, _memory, _output = window, memory, output
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    if interval and _exporter is None:
+        stop_event = threading.Event()      ## each exporter thread has its own, as disable() drops _exporter
+        def export_loop():
+            while not stop_event.wait(interval):
+                export(output)
+        _exporter = threading.Thread(target=export_loop, name='instrumentation', daemon=True)
+        _exporter.stop_event = stop_event
+        _exporter.start()
+    if not _atexit_registered:      ## once, even if enabled again after disable()
+        atexit.register(lambda: export(_output))
+        _atexit_registered = True
+    enabled = True
+
+def disable():
+    global enabled, _exporter
+    enabled = False
+    if _exporter is not None:
+        _exporter.stop_event.set()
+        if _exporter is not threading.current_thread():
+            _exporter.join()        ## a report being written is finished before e.g. the interpreter exits
+        _exporter = None
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+
+if os.environ.get('ECHELLE_PROFILE'):
+    enable(output=None if os.environ['ECHELLE_PROFILE'] in ('1', 'stdout') else os.environ['ECHELLE_PROFILE'])
@@ -0,0 +1,109 @@
+#!/usr/bin/python3
+#-*- coding: utf-8 -*-
+
+"""
+Access to the tabulated spectral lines in ../spectral_data/.
+
+On the first use, each text file is parsed and stored next to it as a binary `.catalog.npy` file, sorted by
+wavelength; later on, the binary file is memory-mapped instead, until the text file changes. Lines within a range
+of wavelengths are then found by bisection, without reading the rest of the catalog.
+
+Usage:
+    catalog = LineCatalog('neon-nist.csv')
+    wavelengths, intensities = catalog.range(500e-9, 700e-9)
+    artif_y = synthetic_spectrum(artif_x, wavelengths, intensities, width=1e-9)
+"""
+
+import os
+import re
+
+import numpy as np
+
+
+spectral_data_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'spectral_data')
+catalog_dtype = np.dtype([('wavelength', 'f8'), ('intensity', 'f8')])
+
+
+def parse_line_file(file_name):
+    """
+    Reads the wavelengths (nm) and relative intensities from one of the supported text formats:
+        * NIST tables saved as tab-separated text (neon-nist.csv): the observed wavelength, or the Ritz wavelength
+          if not observed, and the relative intensity, stripped of the flags like '50*' or '20f'
+        * whitespace-separated columns of wavelength and optionally intensity (neon-nist-cropped.dat,
+          neon-data.csv); missing intensities are set to 1
+    Output:
+        structured array with the fields 'wavelength' (in m) and 'intensity', sorted by wavelength
+    """
+    records = []
+    with open(file_name, encoding='utf-8') as line_file:
+        for line in line_file:
+            if line.startswith('#') or not line.strip():
+                continue
+            columns = [column.strip() for column in (line.split('\t') if '\t' in line.strip() else line.split())]
+            if len(columns) > 4:        ## NIST table
+                wavelength = columns[0] or columns[2]
+                intensity = re.match(r'[0-9.]*', columns[4]).group()
+            else:
+                wavelength, intensity = columns[0], (columns[1] if len(columns) > 1 else '1')
+            try:
+                records.append((float(wavelength)*1e-9, float(intensity or 'nan')))
+            except ValueError:
+                pass                    ## e.g. empty separator rows in the NIST table
+    catalog = np.array(records, dtype=catalog_dtype)
+    return np.sort(catalog, order='wavelength')
+
+class LineCatalog():
+    """
+    Input:
+        file_name   - name of the text file in ../spectral_data/, or a path to it
+    Attributes:
+        wavelengths, intensities - sorted 1D arrays (memory-mapped from the binary cache)
+    """
+    def __init__(self, file_name='neon-nist-cropped.dat'):
+        if not os.path.exists(file_name):
+            file_name = os.path.join(spectral_data_dir, file_name)
+        cache_name = file_name + '.catalog.npy'
+        self.catalog = None
+        if not os.path.exists(cache_name) or os.path.getmtime(cache_name) < os.path.getmtime(file_name):
+            catalog = parse_line_file(file_name)
+            try:
+                np.save(cache_name, catalog)
+            except IOError:             ## read-only installation
+                self.catalog = catalog
+        if self.catalog is None:
+            self.catalog = np.load(cache_name, mmap_mode='r')
+        self.wavelengths = self.catalog['wavelength']
+        self.intensities = self.catalog['intensity']
+
+    def __len__(self):
+        return len(self.catalog)
+
+    def range(self, lmin, lmax):
+        """ Returns (wavelengths, intensities) of the lines with lmin <= λ < lmax """
+        start, stop = np.searchsorted(self.wavelengths, [lmin, lmax])
+        return self.wavelengths[start:stop], self.intensities[start:stop]
+
+    def strongest(self, n, lmin=0, lmax=np.inf):
+        """ Returns (wavelengths, intensities) of the `n` strongest lines within the range, strongest first """
+        wavelengths, intensities = self.range(lmin, lmax)
+        order = np.argsort(np.nan_to_num(intensities, nan=0))[::-1][:n]
+        return wavelengths[order], intensities[order]
+
+
+def synthetic_spectrum(grid, wavelengths, amplitudes, width=1e-9, window=6.):
+    """
+    Sum of Gaussian lines exp(-(λ-λ0)²/width²) × amplitude, evaluated on the sorted grid. Each line only contributes
+    within ±window×width, so the cost grows with the number of lines times the grid points per line, not times
+    the whole grid.
+    """
+    grid = np.asarray(grid)
+    wavelengths, amplitudes = np.broadcast_arrays(np.asarray(wavelengths, dtype=float), np.asarray(amplitudes, dtype=float))
+    start = np.searchsorted(grid, wavelengths - window*width)
+    stop  = np.searchsorted(grid, wavelengths + window*width)
+    counts = stop - start
+
+    ## indices of all (line, grid point) pairs at once: a ramp restarting at each line's `start`
+    line_index = np.repeat(np.arange(len(wavelengths)), counts)
+    grid_index = np.arange(np.sum(counts)) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(start, counts)
+    values = np.exp(-((grid[grid_index] - wavelengths[line_index])/width)**2) * amplitudes[line_index]
+    return np.bincount(grid_index, weights=values, minlength=len(grid))
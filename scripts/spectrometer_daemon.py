@@ -0,0 +1,240 @@
+#!/usr/bin/python3
+#-*- coding: utf-8 -*-
+
+"""
+Long-running acquisition server, which keeps the camera session open and the calibration and trace tables loaded,
+so that each spectrum costs only its exposure, download and processing.
+
+The requests are accepted on a local Unix socket, as one JSON object per line, and each is answered by one JSON
+line, e.g.
+    {"command": "capture", "shutterspeed": "1/100", "iso": "100"}
+            -> {"ok": true, "timestamp": ..., "exposure": 0.01, "wavelength": [...], "intensity": [...]}
+    {"command": "capture", "bracket": ["1/500", "1/100"], "output": "/data/spectrum.dat"}
+            -> {"ok": true, "timestamp": ..., "output": "/data/spectrum.dat"}      ## written by the server
+    {"command": "status"}       -> {"ok": true, "state": "capturing", "captures": 12, ...}
+    {"command": "reload"}       -> re-reads the echelle parameters from the settings file
+    {"command": "shutdown"}
+The server runs on asyncio: the camera is used from one worker thread and the processing runs in another, so that
+status queries are answered at once even during a long exposure, and the next capture overlaps the processing of
+the previous one. Errors are returned as {"ok": false, "error": "..."} and do not stop the server.
+
+Usage:
+    ./spectrometer_daemon.py serve -s gui_setup/echelle_settings.dat &
+    ./spectrometer_daemon.py serve --replay '../image_logs/*.cr2' &     ## with recorded frames instead of the camera
+    ./spectrometer_daemon.py capture --shutterspeed 1/100 -o spectrum.dat
+    ./spectrometer_daemon.py status
+"""
+
+import argparse
+import asyncio
+import concurrent.futures
+import io
+import json
+import os
+import socket
+import tempfile
+import time
+
+import numpy as np
+
+import camera as cameras
+import echelle_process
+import hdr
+
+
+default_socket_path = os.path.join(tempfile.gettempdir(), 'unechelle-spectrometer.sock')
+
+
+class SpectrometerDaemon():
+    """
+    Input:
+        camera          - camera object as defined in camera.py; opened by serve() and closed at the shutdown
+        settings_file_name - the echelle parameters, (re)loaded at start and at each "reload" command
+        calibration     - optional master dark/flat frames (calibration_frames.CalibrationFrames)
+    """
+    def __init__(self, camera, settings_file_name='./echelle_parameters.dat', socket_path=default_socket_path,
+            decimate_factor=4, method='aperture', calibration=None):
+        self.camera             = camera
+        self.settings_file_name = settings_file_name
+        self.socket_path        = socket_path
+        self.decimate_factor    = decimate_factor
+        self.method             = method
+        self.calibration        = calibration
+        self.camera_worker      = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='camera')
+        self.processing_worker  = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='processing')
+        self.image_shape        = None
+        self.status = {'state': 'starting', 'captures': 0, 'processing': 0, 'completed': 0, 'errors': 0,
+                'last_error': None, 'last_capture_s': None, 'last_processing_s': None}
+        self.load_params()
+
+    def load_params(self):
+        """ Loads the parameters, and if the image shape is already known, builds the trace table and stitcher at once """
+        self.params = echelle_process.complete_params(echelle_process.load_echelle_parameters(self.settings_file_name))
+        if self.image_shape is not None:
+            echelle_process.trace_table(self.params, self.image_shape).stitcher()
+
+    ## the blocking parts, run in the worker threads
+    def _capture(self, settings, bracket):
+        """ Output: (RAW data, exposure in seconds as captured, or None for a bracket) """
+        self.camera.set_config(**settings)
+        shutterspeed = self.camera.settings['shutterspeed']
+        if bracket:
+            try:
+                return hdr.capture_bracket(self.camera, bracket), None
+            finally:        ## so that the later captures without a shutter speed keep the default one
+                self.camera.set_config(shutterspeed=shutterspeed)
+        return self.camera.capture(), hdr.exposure_seconds(shutterspeed)
+
+    def _process(self, raw_data, bracket, params, method):
+        if bracket:
+            image = echelle_process.decimate(hdr.merge_raw_data(raw_data), self.decimate_factor)
+            image -= image.min()
+        else:
+            image = echelle_process.load_raw(io.BytesIO(raw_data), decimate_factor=self.decimate_factor,
+                    params=params, calibration=self.calibration)
+        self.image_shape = image.shape
+        return echelle_process.img2spectrum(image, params, method=method)
+
+    ## the request handlers
+    async def capture(self, request):
+        loop = asyncio.get_running_loop()
+        settings = {key: str(request[key]) for key in ('shutterspeed', 'iso') if key in request}
+        bracket = request.get('bracket')
+        params, method = self.params, request.get('method', self.method)
+        ## checked before anything is sent to the camera
+        for shutterspeed in ([settings['shutterspeed']] if 'shutterspeed' in settings else []) + (bracket or []):
+            hdr.exposure_seconds(shutterspeed)
+
+        self.status['captures'] += 1
+        t0 = time.time()
+        try:
+            raw_data, exposure = await loop.run_in_executor(self.camera_worker, self._capture, settings, bracket)
+        finally:
+            self.status['captures'] -= 1
+        timestamp = time.time()
+        self.status['last_capture_s'] = timestamp - t0
+
+        self.status['processing'] += 1
+        try:
+            wavelength, intensity = await loop.run_in_executor(self.processing_worker, self._process, raw_data,
+                    bracket, params, method)
+        finally:
+            self.status['processing'] -= 1
+        self.status['last_processing_s'] = time.time() - timestamp
+        self.status['completed'] += 1
+
+        response = {'ok': True, 'timestamp': t0, 'exposure': exposure}
+        if request.get('output'):
+            np.savetxt(request['output'], np.vstack([wavelength*1e9, intensity]).T, fmt="%.5f %.6g",
+                    header='wavelength(nm) intensity')
+            response['output'] = request['output']
+        else:
+            finite = np.isfinite(intensity)
+            response['wavelength'] = wavelength[finite].tolist()
+            response['intensity'] = intensity[finite].tolist()
+        return response
+
+    async def status_query(self, request):
+        state = 'capturing' if self.status['captures'] else ('processing' if self.status['processing'] else 'idle')
+        return dict(self.status, ok=True, state=state, uptime_s=time.time() - self.t_start,
+                settings=dict(self.camera.settings), image_shape=self.image_shape,
+                settings_file=os.path.abspath(self.settings_file_name))
+
+    async def reload(self, request):
+        await asyncio.get_running_loop().run_in_executor(self.processing_worker, self.load_params)
+        return {'ok': True}
+
+    async def shutdown(self, request):
+        self.stop_event.set()
+        return {'ok': True}
+
+    async def handle_connection(self, reader, writer):
+        handlers = {'capture': self.capture, 'status': self.status_query, 'reload': self.reload,
+                'shutdown': self.shutdown}
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    request = json.loads(line)
+                    handler = handlers.get(request.get('command'))
+                    if handler is None:
+                        response = {'ok': False, 'error': 'unknown command: {}'.format(request.get('command'))}
+                    else:
+                        response = await handler(request)
+                except Exception as e:
+                    self.status['errors'] += 1
+                    self.status['last_error'] = '{}: {}'.format(type(e).__name__, e)
+                    response = {'ok': False, 'error': self.status['last_error']}
+                writer.write(json.dumps(response).encode() + b'\n')
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self):
+        """ Runs until the "shutdown" command """
+        self.stop_event = asyncio.Event()
+        self.t_start = time.time()
+        await asyncio.get_running_loop().run_in_executor(self.camera_worker, self.camera.open)
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)      ## left over from a previous server that did not exit cleanly
+        server = await asyncio.start_unix_server(self.handle_connection, path=self.socket_path, limit=2**20)
+        self.status['state'] = 'idle'
+        try:
+            async with server:
+                await self.stop_event.wait()
+        finally:
+            await asyncio.get_running_loop().run_in_executor(self.camera_worker, self.camera.close)
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+            self.camera_worker.shutdown()
+            self.processing_worker.shutdown()
+
+
+def request(command, socket_path=default_socket_path, timeout=None, **arguments):
+    """ Sends one request to the server and returns its (decoded) response; for use from other scripts """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.settimeout(timeout)
+        client.connect(socket_path)
+        client.sendall(json.dumps(dict(arguments, command=command)).encode() + b'\n')
+        with client.makefile('rb') as response:
+            return json.loads(response.readline())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('command', choices=['serve', 'capture', 'status', 'reload', 'shutdown'])
+    parser.add_argument('--socket', default=default_socket_path, help='path of the Unix socket')
+    parser.add_argument('-s', '--settings', default='./echelle_parameters.dat', help='echelle parameters file (serve)')
+    parser.add_argument('-r', '--replay', default=None, metavar='GLOB', help='use saved RAW files instead of the camera (serve)')
+    parser.add_argument('-d', '--decimate', type=int, default=4, help='decimate factor (serve)')
+    parser.add_argument('--calibration', default=None, metavar='DIR', help='master dark/flat frames directory (serve)')
+    parser.add_argument('--shutterspeed', default=None, help='exposure of the capture, e.g. 1/100')
+    parser.add_argument('--iso', default=None)
+    parser.add_argument('-b', '--bracket', default=None, metavar='SPEEDS', help='comma-separated shutter speeds (capture)')
+    parser.add_argument('-o', '--output', default=None, help='file for the spectrum, written by the server (capture)')
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        camera = cameras.ReplayCamera(args.replay) if args.replay else cameras.GphotoCamera()
+        calibration = None
+        if args.calibration:
+            import calibration_frames
+            calibration = calibration_frames.CalibrationFrames.load(args.calibration)
+        daemon = SpectrometerDaemon(camera, settings_file_name=args.settings, socket_path=args.socket,
+                decimate_factor=args.decimate, calibration=calibration)
+        print("Listening on {}".format(args.socket))
+        asyncio.run(daemon.serve())
+    else:
+        arguments = {key: val for key, val in (('shutterspeed', args.shutterspeed), ('iso', args.iso),
+                ('bracket', args.bracket.split(',') if args.bracket else None),
+                ('output', os.path.abspath(args.output) if args.output else None)) if val is not None}
+        response = request(args.command, socket_path=args.socket, **arguments)
+        if 'intensity' in response:     ## not saved by the server, so print the spectrum
+            for wavelength, intensity in zip(response.pop('wavelength'), response.pop('intensity')):
+                print("{:.5f} {:.6g}".format(wavelength*1e9, intensity))
+        else:
+            print(json.dumps(response, indent=1))
@@ -0,0 +1,160 @@
+#!/usr/bin/python3
+#-*- coding: utf-8 -*-
+
+"""
+Appendable on-disk store for long series of spectra sharing one wavelength grid.
+
+A store is a directory containing
+    grid.npy            - the wavelength grid (m), written once
+    calibration.dat     - the echelle parameters the spectra were computed with (as saved by gui_setup.py)
+    header.json         - the grid length and the number of preallocated rows
+    spectra.bin         - (row × wavelength) float32 array of intensities, memory-mapped
+    frames.bin          - one record per row: timestamp, exposure (s), ISO and frame index, memory-mapped
+The rows are preallocated in chunks, so appending a spectrum only copies it into the mapped file. A row counts as
+stored once its timestamp is written, which is done last; after an interruption, the store thus reopens with all
+complete rows. Since the timestamps and the grid are sorted, any time slice or wavelength band is found by
+bisection and read without touching the rest of the file.
+
+Usage:
+    store = SpectrumStore('../spectra/run1', grid=wavelength, params=params)
+    store.append(intensity, timestamp=time.time(), exposure=1/500, iso=100)
+    ...
+    wavelength, times, intensities = SpectrumStore('../spectra/run1').select(tmin, tmax, 650e-9, 660e-9)
+"""
+
+import json
+import os
+
+import numpy as np
+
+import echelle_process
+
+
+frame_dtype = np.dtype([('timestamp', 'f8'), ('exposure', 'f8'), ('iso', 'f4'), ('index', 'i8')])
+
+
+class SpectrumStore():
+    """
+    Input:
+        directory   - the store; created if it does not exist yet
+        grid        - the wavelength grid (m); required for a new store, and checked against an existing one
+        params      - echelle parameters saved along with a new store
+        chunk_rows  - number of rows preallocated at once
+    Attributes:
+        grid        - 1D array of wavelengths (m)
+        intensities - (row × wavelength) memory-mapped array of the stored spectra
+        frames      - structured array of the per-row metadata (fields as in `frame_dtype`)
+        timestamps  - 1D array of the stored timestamps (s since epoch)
+    """
+    def __init__(self, directory, grid=None, params=None, chunk_rows=256):
+        self.directory  = directory
+        self.chunk_rows = chunk_rows
+        if not os.path.exists(os.path.join(directory, 'header.json')):
+            if grid is None:
+                raise ValueError("`{}` is not a spectrum store, and no wavelength grid is given to create one".format(directory))
+            os.makedirs(directory, exist_ok=True)
+            np.save(os.path.join(directory, 'grid.npy'), np.asarray(grid, dtype=np.float64))
+            if params is not None:
+                echelle_process.save_echelle_parameters(params, os.path.join(directory, 'calibration.dat'), verbose=False)
+            for name in ('spectra.bin', 'frames.bin'):
+                open(os.path.join(directory, name), 'wb').close()
+            self._write_header(capacity=0)
+
+        self.grid = np.load(os.path.join(directory, 'grid.npy'), mmap_mode='r')
+        if grid is not None and (len(grid) != len(self.grid) or not np.allclose(grid, self.grid, rtol=1e-9, atol=0)):
+            raise ValueError("the wavelength grid differs from the one in `{}`".format(directory))
+        with open(os.path.join(directory, 'header.json')) as header:
+            self._map(json.load(header)['capacity'])
+        ## rows are complete once their timestamp is written, and appended in time order
+        self.count = int(np.count_nonzero(self._frames['timestamp']))
+
+    def _write_header(self, capacity):
+        with open(os.path.join(self.directory, 'header.json'), 'w') as header:
+            json.dump({'grid_length': len(np.load(os.path.join(self.directory, 'grid.npy'), mmap_mode='r')),
+                    'capacity': capacity, 'dtype': 'float32'}, header)
+
+    def _map(self, capacity):
+        """ (Re)maps both data files, extending them to `capacity` rows if needed """
+        self.capacity = capacity
+        for name, itemsize in (('spectra.bin', len(self.grid)*4), ('frames.bin', frame_dtype.itemsize)):
+            file_name = os.path.join(self.directory, name)
+            if os.path.getsize(file_name) < capacity*itemsize:
+                with open(file_name, 'r+b') as data_file:
+                    data_file.truncate(capacity*itemsize)   ## sparse zeros, no data written
+        if capacity:
+            self._intensities = np.memmap(os.path.join(self.directory, 'spectra.bin'), dtype=np.float32, mode='r+',
+                    shape=(capacity, len(self.grid)))
+            self._frames = np.memmap(os.path.join(self.directory, 'frames.bin'), dtype=frame_dtype, mode='r+',
+                    shape=(capacity,))
+        else:
+            self._intensities = np.zeros((0, len(self.grid)), dtype=np.float32)
+            self._frames = np.zeros(0, dtype=frame_dtype)
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def intensities(self):
+        return self._intensities[:self.count]
+
+    @property
+    def frames(self):
+        return self._frames[:self.count]
+
+    @property
+    def timestamps(self):
+        return self._frames['timestamp'][:self.count]
+
+    def params(self):
+        """ The echelle parameters stored with the spectra, or None """
+        file_name = os.path.join(self.directory, 'calibration.dat')
+        return echelle_process.load_echelle_parameters(file_name) if os.path.exists(file_name) else None
+
+    def append(self, intensity, timestamp, exposure=np.nan, iso=np.nan, index=-1, wavelength=None):
+        """
+        Stores one spectrum; if its `wavelength` axis is given and differs from the grid, it is interpolated
+        """
+        if self.count and timestamp < self._frames['timestamp'][self.count-1]:
+            raise ValueError("the spectra must be appended in time order")
+        if wavelength is not None and (len(wavelength) != len(self.grid) or np.any(wavelength != self.grid)):
+            intensity = np.interp(self.grid, wavelength, intensity, left=np.nan, right=np.nan)
+        if self.count == self.capacity:
+            self.flush()
+            self._map(self.capacity + self.chunk_rows)
+            self._write_header(self.capacity)
+        self._intensities[self.count] = intensity
+        self._frames[self.count] = (0, exposure, iso, index)
+        self._frames['timestamp'][self.count] = timestamp
+        self.count += 1
+
+    def flush(self):
+        if self.capacity:
+            self._intensities.flush()
+            self._frames.flush()
+
+    def close(self):
+        self.flush()
+        self._intensities, self._frames = None, None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def time_rows(self, tmin=-np.inf, tmax=np.inf):
+        """ Slice of the rows with tmin <= timestamp < tmax """
+        return slice(*np.searchsorted(self.timestamps, [tmin, tmax]))
+
+    def band_columns(self, lmin=0, lmax=np.inf):
+        """ Slice of the grid points with lmin <= wavelength < lmax """
+        return slice(*np.searchsorted(self.grid, [lmin, lmax]))
+
+    def select(self, tmin=-np.inf, tmax=np.inf, lmin=0, lmax=np.inf):
+        """
+        Output:
+            (wavelengths, timestamps, intensities) - the band of the grid, the timestamps of the time slice, and
+                                                     the (row × wavelength) memory-mapped view of the data
+        """
+        rows, columns = self.time_rows(tmin, tmax), self.band_columns(lmin, lmax)
+        return self.grid[columns], self.timestamps[rows], self.intensities[rows, columns]